@@ -0,0 +1,298 @@
+"""
+This script benchmarks new-morph-test.py on synthetic test suites. It builds
+a lexicon, a matching analyzer/generator pair and a yaml test file for each
+size, then times every phase of a test run separately. The startup of the
+tester, before it reads any test, is timed on its own.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from io import StringIO
+
+import gc
+import importlib.util
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import libhfst
+
+here = os.path.dirname(os.path.abspath(__file__))
+syllables = ['ka', 'ri', 'mo', 'na', 'te', 'lu', 'sa', 'pe',
+             'do', 'gi', 'ba', 'ne', 'ko', 'fu', 'ha', 'je']
+phases = ['yaml_load', 'transducer_load', 'lookup', 'evaluation', 'report']
+# runs of the tester that end before any test is read, timed as a whole
+startup_runs = OrderedDict([('help', ['--help']),
+                            ('argument_error', ['--shard', '0/0', 'x.yaml']),
+                            ('missing_file', ['--no-cache', 'missing.yaml'])])
+
+def argument_parsing():
+    ap = ArgumentParser()
+    ap.description = 'This script benchmarks new-morph-test.py.'
+
+    h = 'Comma separated numbers of tests to benchmark '
+    h += '(Default: 1000,10000,100000).'
+    ap.add_argument('-s', '--sizes', dest='sizes', default='1000,10000,100000',
+                    help=h)
+
+    h = 'Directory where the synthetic files are kept between runs '
+    h += '(Default: a temporary directory).'
+    ap.add_argument('-d', '--workdir', dest='workdir', default=None, help=h)
+
+    h = 'Number of times each size is run, the fastest time of each phase '
+    h += 'is kept (Default: 1).'
+    ap.add_argument('-r', '--repeat', dest='repeat', type=int, default=1,
+                    help=h)
+
+    h = 'Number of processes used for lookups (Default: 1).'
+    ap.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help=h)
+
+    h = 'Lookup backend of the tester, lookup or compose (Default: lookup).'
+    ap.add_argument('-b', '--backend', dest='backend', default='lookup',
+                    choices=['lookup', 'compose'], help=h)
+
+    h = 'Number of times each startup run is timed, the fastest is kept '
+    h += '(Default: 10, 0 skips them).'
+    ap.add_argument('--startup-repeat', dest='startup_repeat', type=int,
+                    default=10, help=h)
+
+    h = 'JSON file the results are written to (Default: standard output).'
+    ap.add_argument('-w', '--output-file', dest='output_file', default=None,
+                    help=h)
+
+    h = 'JSON file from an earlier run to compare the results with.'
+    ap.add_argument('-c', '--compare', dest='compare', default=None, help=h)
+    return ap.parse_args()
+
+def load_tester():
+    # the tester's file name is not a valid module name, so it is loaded by path
+    path = os.path.join(here, 'new-morph-test.py')
+    spec = importlib.util.spec_from_file_location('morph_test', path)
+    tester = importlib.util.module_from_spec(spec)
+    # registered so the lookup workers can unpickle its functions
+    sys.modules['morph_test'] = tester
+    spec.loader.exec_module(tester)
+    return tester
+
+# loaded on import too, as processes the tester starts from a fork server
+# import this file again before they unpickle its functions
+tester = load_tester()
+
+def make_word(i, rnd):
+    # a random syllable followed by i written in syllables, so words are unique
+    word = rnd.choice(syllables)
+    while True:
+      word += syllables[i % len(syllables)]
+      i //= len(syllables)
+      if not i: return word
+
+def make_suite(size, workdir):
+    """
+    Writes a generator, an analyzer and a yaml file with about `size` tests.
+    Files that already exist are reused. Returns the path of the yaml file.
+    """
+    yaml_path = os.path.join(workdir, 'bench-{}.yaml'.format(size))
+    gen_path = os.path.join(workdir, 'bench-{}.autogen.hfst'.format(size))
+    morph_path = os.path.join(workdir, 'bench-{}.automorf.hfst'.format(size))
+    if all(os.path.exists(p) for p in [yaml_path, gen_path, morph_path]):
+      return yaml_path
+
+    # each lemma has a singular and a plural, one test for each
+    rnd = random.Random(size)
+    lemmas = [make_word(i, rnd) for i in range(max(size // 2, 1))]
+    basic = libhfst.HfstBasicTransducer()
+    for lemma in lemmas:
+      for tag, suffix in [('<sg>', ''), ('<pl>', 's')]:
+        lexical = tuple(lemma) + ('<n>', tag)
+        surface = tuple(lemma + suffix)
+        # both sides are padded with epsilons to the same length
+        length = max(len(lexical), len(surface))
+        pad = ('@_EPSILON_SYMBOL_@',)
+        pairs = zip(lexical + pad * (length - len(lexical)),
+                    surface + pad * (length - len(surface)))
+        basic.disjunct(tuple(pairs), 0)
+
+    generator = libhfst.HfstTransducer(basic,
+                          libhfst.ImplementationType.TROPICAL_OPENFST_TYPE)
+    generator.minimize()
+    analyzer = libhfst.HfstTransducer(generator)
+    analyzer.invert()
+    analyzer.minimize()
+    for transducer, path in [(generator, gen_path), (analyzer, morph_path)]:
+      transducer.convert(libhfst.ImplementationType.HFST_OLW_TYPE)
+      transducer.write_to_file(path)
+
+    # every seventh test expects a wrong form so there are failures to report,
+    # and a tenth of the lemmas are repeated in a last section
+    lines = ['Config:', '  hfst:', '    App: hfst-lookup',
+             '    Gen: {}'.format(gen_path), '    Morph: {}'.format(morph_path),
+             'Tests:']
+    for start in range(0, len(lemmas), 500):
+      lines.append('  Section {}:'.format(start // 500))
+      for i, lemma in enumerate(lemmas[start:start+500], start):
+        wrong = 'x' if i % 7 == 0 else ''
+        lines.append('    {}<n><sg>:'.format(lemma))
+        lines.append('      <=>: {}{}'.format(lemma, wrong))
+        lines.append('    {}<n><pl>:'.format(lemma))
+        lines.append('      <=>:')
+        lines.append('        - {}s'.format(lemma))
+    lines.append('  Repeated:')
+    for lemma in lemmas[::10]:
+      lines.append('    {}<n><sg>:'.format(lemma))
+      lines.append('      <=>: {}'.format(lemma))
+    with open(yaml_path, 'w') as f: f.write('\n'.join(lines) + '\n')
+    return yaml_path
+
+def run_phases(tester, yaml_path, jobs, backend):
+    """
+    Runs the tests in yaml_path the same way Results.run does, but timing
+    each phase on its own. Returns the timings and a few counts.
+    """
+    options = ['--no-cache', '-j', str(jobs), '--backend', backend]
+    args = tester.argument_parsing(options + [yaml_path])
+    timings = OrderedDict()
+
+    start = time.perf_counter()
+    sections, morph, gen, limits = tester.load_data(args, yaml_path)
+    timings['yaml_load'] = time.perf_counter() - start
+
+    results = tester.Results(sections, morph, gen, args, StringIO())
+    results.prepare()
+    start = time.perf_counter()
+    if backend == 'compose':
+      results.engine.composable('ana')
+      results.engine.composable('gen')
+    elif jobs > 1:
+      # workers read their own copy of the transducers when their pool starts
+      results.engine.pool('ana')
+      results.engine.pool('gen')
+    else:
+      results.engine.transducer('ana')
+      results.engine.transducer('gen')
+    timings['transducer_load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if backend == 'compose': results.prefetch(results.selected)
+    for section in results.selected:
+      results.lookup(section)
+    timings['lookup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for section in results.selected:
+      results.evaluate(section)
+      results.add_counts(section)
+    timings['evaluation'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for section in results.selected:
+      results.print_normal(section)
+    results.print_final()
+    timings['report'] = time.perf_counter() - start
+    results.engine.close()
+
+    counts = OrderedDict()
+    counts['tests'] = sum(len(section.tests) for section in sections)
+    counts['lookups'] = results.engine.requested
+    counts['unique_lookups'] = results.engine.performed
+    counts['fails'] = results.ana_fails + results.gen_fails
+
+    # the same run as the tester does it, with the phases overlapping, the 
+    # tests above are dropped first or the garbage collector keeps going 
+    # through them and slows the run down
+    del sections, results
+    gc.collect()
+    args = tester.argument_parsing(options + ['-o', 'none', yaml_path])
+    start = time.perf_counter()
+    with redirect_stdout(StringIO()): tester.run_tests(args)
+    timings['pipeline'] = time.perf_counter() - start
+    return timings, counts
+
+def time_startup(repeat):
+    """
+    Times whole runs of the tester that stop at --help, an argument error or
+    a missing file, so only its startup is measured. Returns the fastest time
+    of each, along with that of an empty python for reference.
+    """
+    path = os.path.join(here, 'new-morph-test.py')
+    commands = OrderedDict([('python', [sys.executable, '-c', 'pass'])])
+    for name, options in startup_runs.items():
+      commands[name] = [sys.executable, path] + options
+    timings = OrderedDict()
+    for name, command in commands.items():
+      best = None
+      for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, 
+                       stderr=subprocess.DEVNULL, cwd=here)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+      timings[name] = best
+    return timings
+
+def compare(results, path):
+    # prints how much slower (>1) or faster (<1) each phase is than before
+    with open(path) as f: old = json.load(f)
+    if 'startup' in results and 'startup' in old:
+      print('startup:', file=sys.stderr)
+      for name, after in results['startup'].items():
+        if name not in old['startup']: continue
+        before = old['startup'][name]
+        ratio = after / before if before else float('inf')
+        print('  {:<16} {:>9.3f}s -> {:>9.3f}s  x{:.2f}'.format(name, before,
+              after, ratio), file=sys.stderr)
+    old_sizes = {run['size']: run for run in old['runs']}
+    for run in results['runs']:
+      if run['size'] not in old_sizes: continue
+      print('size {}:'.format(run['size']), file=sys.stderr)
+      for phase in phases + ['total', 'pipeline']:
+        if phase not in old_sizes[run['size']]['timings']: continue
+        before = old_sizes[run['size']]['timings'][phase]
+        after = run['timings'][phase]
+        ratio = after / before if before else float('inf')
+        print('  {:<16} {:>9.3f}s -> {:>9.3f}s  x{:.2f}'.format(phase, before,
+              after, ratio), file=sys.stderr)
+
+def main():
+    args = argument_parsing()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='morph-test-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = OrderedDict()
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    results['jobs'] = args.jobs
+    results['backend'] = args.backend
+    if args.startup_repeat > 0:
+      print('Benchmarking startup...', file=sys.stderr)
+      results['startup'] = time_startup(args.startup_repeat)
+    results['runs'] = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+      print('Benchmarking {} tests...'.format(size), file=sys.stderr)
+      yaml_path = make_suite(size, workdir)
+      best = None
+      for i in range(args.repeat):
+        timings, counts = run_phases(tester, yaml_path, args.jobs, 
+                                     args.backend)
+        if best is None: best = timings
+        else: best = OrderedDict((phase, min(best[phase], timings[phase]))
+                                 for phase in phases + ['pipeline'])
+      best['total'] = sum(best[phase] for phase in phases)
+
+      run = OrderedDict([('size', size)])
+      run.update(counts)
+      run['timings'] = best
+      results['runs'].append(run)
+
+    s = json.dumps(results, indent=2)
+    if args.output_file:
+      with open(args.output_file, 'w') as f: f.write(s + '\n')
+    else: print(s)
+    if args.compare: compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
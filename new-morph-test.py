@@ -4,18 +4,41 @@ Author: Danielle Rossetti Dos Santos
 """
 
 from argparse import ArgumentParser
-from collections import OrderedDict
-from io import StringIO
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 
 import sys 
-import libhfst
-import yaml
+import os
+import glob
+import hashlib
+import json
+import marshal
+import re
+import socket
+import threading
+import time
+import traceback
 import textwrap 
 
+# libhfst, yaml and xml.sax.saxutils take longer to import than everything
+# else together, and cProfile, sqlite3 and multiprocessing are only needed
+# by some runs, so they are imported by the functions that need them: --help,
+# argument errors or a run answered by a server never load them
+
 # defining a few strings that are used often
 pass_mark = '{green}[✓]{reset}'
 fail_mark = '{red}[✗]{reset}'
 na_mark = ' - '
+limit_mark = '{yellow}[…]{reset}'
+
+# bits of the verdict kept by each test once it has been evaluated
+ana_passed_bit = 1
+gen_passed_bit = 2
+failed_bit = 4
+
+# output styles that are meant to be read by people, and by other programs
+text_outputs = ['normal', 'compact', 'final']
+machine_outputs = ['jsonl', 'junit']
 
 def error_checking(n):
     """
@@ -32,11 +55,28 @@ def error_checking(n):
       msg += 'make sure items under "Tests" are mappings and follow the format.'
     elif n == 6: msg += 'possible direction arrows are =>, <=, or <=>.'
     elif n == 7: msg += 'the section requested does not exist.'
-    elif n == 8: msg += 'the output options are: normal, compact, final, none.'
+    elif n == 8: 
+      msg += 'the output options are: normal, compact, final, jsonl, junit, '
+      msg += 'none.'
+    elif n == 9: msg += 'there was an error opening a transducer.'
+    elif n == 10: msg += 'a filter is not a valid regular expression.'
+    elif n == 11: msg += 'there was an error opening the output file.'
+    elif n == 12: msg += 'could not connect to the test server.'
+    elif n == 13: msg += 'there was an error writing the baseline file.'
+    elif n == 14: 
+      msg += 'MaxResults and TimeLimit in "Config", and --max-results and '
+      msg += '--time-limit, should be positive numbers.'
+    elif n == 15: msg += 'there was an error reading the results to merge.'
+    elif n == 16: msg += 'some shards are missing from the merged results.'
+    elif n == 17: msg += 'there was an error reading the corpus.'
+    elif n == 18: msg += 'there was an error reading the word list.'
+    elif n == 19: 
+      msg += 'the results to merge should have one "totals" record for each '
+      msg += 'test file, a run may not have finished.'
     print(msg)
     sys.exit(n)
 
-def argument_parsing():
+def argument_parsing(argv=None):
     ap = ArgumentParser()
     ap.description = 'This script performs a morphological test.'
     
@@ -44,9 +84,15 @@ def argument_parsing():
     h += '*normal (TP, TN, FP, FN for each analysis and generationt test)\n'
     h += '*compact (whether sections passed or failed)\n'
     h += '*final (total number of passes, fails, and overall tests)\n'
+    h += '*jsonl (one JSON record per test, then one with the totals)\n'
+    h += '*junit (JUnit XML, one testsuite per section)\n'
     h += '*none (no output, only exit code)\n'
     h += '(Default: normal)'
     ap.add_argument('-o', '--output', dest='output', default='normal', help=h)
+
+    h = 'File the results are written to (Default: standard output).'
+    ap.add_argument('-w', '--output-file', dest='output_file', default=None,
+                    help=h)
     
     h = 'Ignores analysis false positives. '
     h += 'Will pass if expected results are found.'
@@ -63,96 +109,326 @@ def argument_parsing():
     ap.add_argument('-f', '--hide-passes', dest='hide_pass', 
                     action='store_true', help=h)
 
-    h = 'Section to run tests on (Default: all). Enter the # of the section.'
-    ap.add_argument('-t', '--test', dest='test', type=int, default='-1', help=h)
+    h = 'Section to run tests on (Default: all). Enter the # or the name of '
+    h += 'the section, use more than once for several sections.'
+    ap.add_argument('-t', '--test', dest='test', action='append', help=h)
+
+    h = 'Only runs tests whose left or right side matches REGEX. If REGEX '
+    h += 'starts with "SECTION:", only tests of that section are matched. '
+    h += 'Use more than once for several filters.'
+    ap.add_argument('--filter', dest='filter', action='append',
+                    metavar='[SECTION:]REGEX', help=h)
   
+    h = 'Only runs shard I of N, a share of the tests picked by a hash of '
+    h += 'each test, so every run with the same N splits the tests the same '
+    h += 'way. Use with -o jsonl and merge the shards with --merge.'
+    ap.add_argument('--shard', dest='shard', default=None, metavar='I/N',
+                    help=h)
+
+    h = 'Merges the -o jsonl results of several runs, e.g. the shards of a '
+    h += 'suite, given instead of test files, and prints their overall '
+    h += 'results and exits like a single run would.'
+    ap.add_argument('--merge', dest='merge', action='store_true', help=h)
+
+    h = 'Instead of running the tests, analyzes every word of a text corpus '
+    h += '("-" for standard input, except with --connect) with the analyzer '
+    h += 'of the test file and reports how many are known, and the most '
+    h += 'frequent unknown words. Each different word is only analyzed once.'
+    ap.add_argument('--coverage', dest='coverage', default=None, 
+                    metavar='CORPUS', help=h)
+
+    h = 'Instead of running the tests, analyzes every word of --word-list, '
+    h += 'or every right side of the tests, generates from each analysis and '
+    h += 'reports the words that are not generated again or that get other '
+    h += 'forms too.'
+    ap.add_argument('--round-trip', dest='round_trip', action='store_true', 
+                    help=h)
+
+    h = 'Word list for --round-trip, one word per line ("-" for standard '
+    h += 'input, except with --connect).'
+    ap.add_argument('--word-list', dest='word_list', default=None, 
+                    metavar='FILE', help=h)
+
+    h = 'Number of unknown words listed by --coverage, or of words listed by '
+    h += '--round-trip (Default: 20).'
+    ap.add_argument('--top', dest='top', type=int, default=20, help=h)
+
+    h = 'Converts the transducers to optimized-lookup format before running '
+    h += 'the tests. Converted transducers are kept in the cache directory.'
+    ap.add_argument('-O', '--optimize', dest='optimize', action='store_true',
+                    help=h)
+
+    h = 'Directory for cached files '
+    h += '(Default: .morph-test-cache next to the test file).'
+    ap.add_argument('--cache-dir', dest='cache_dir', default=None, help=h)
+
+    h = 'Does not read or write cached lookup results and test files.'
+    ap.add_argument('--no-cache', dest='no_cache', action='store_true', help=h)
+
+    h = 'Maximum number of lookup results kept in the cache (Default: 1000000).'
+    ap.add_argument('--cache-size', dest='cache_size', type=int,
+                    default=1000000, help=h)
+
+    h = 'Records the lookup results and pass/fail state of every test in a '
+    h += 'baseline file in the cache directory.'
+    ap.add_argument('--write-baseline', dest='write_baseline',
+                    action='store_true', help=h)
+
+    h = 'Only looks up tests that changed since the baseline was written, or '
+    h += 'all tests of a transducer that changed, and reports new failures '
+    h += 'and new passes. The baseline is updated afterwards.'
+    ap.add_argument('--since-baseline', dest='since_baseline',
+                    action='store_true', help=h)
+
+    h = 'Runs the tests that failed in the last few runs first, within their '
+    h += 'sections, which go first too. The failures of each run are kept in '
+    h += 'the cache directory, unless --no-cache is used.'
+    ap.add_argument('--failed-first', dest='failed_first', action='store_true',
+                    help=h)
+
+    h = 'Stops as soon as N tests have failed, without looking up the tests '
+    h += 'that are left, and exits with 1. Implies --failed-first.'
+    ap.add_argument('--max-failures', dest='max_failures', type=int, 
+                    default=None, metavar='N', help=h)
+
+    h = 'Number of processes used for lookups (Default: 1).'
+    ap.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help=h)
+
+    h = 'Maximum number of results kept for each lookup, inputs with more are '
+    h += 'reported as limited instead of passing or failing (Default: '
+    h += 'MaxResults in "Config", or no limit).'
+    ap.add_argument('--max-results', dest='max_results', type=int, 
+                    default=None, help=h)
+
+    h = 'Seconds a single lookup may take, inputs that take longer are '
+    h += 'reported as limited (Default: TimeLimit in "Config", or no limit). '
+    h += 'Transducers are converted to optimized-lookup for it, as with '
+    h += '--optimize. Not used by --backend compose, which reports inputs '
+    h += 'with a cycle as limited instead.'
+    ap.add_argument('--time-limit', dest='time_limit', type=float,
+                    default=None, help=h)
+
+    h = 'How strings are looked up: *lookup (one lookup per string, the '
+    h += 'default), *compose (all the strings of a section at once, by '
+    h += 'composing them with the transducer). --jobs only applies to lookup.'
+    ap.add_argument('--backend', dest='backend', default='lookup', 
+                    choices=['lookup', 'compose'], help=h)
+
+    h = 'Writes the time spent in each phase of the run, and lookup counts '
+    h += 'and latencies for each section, to a JSON file.'
+    ap.add_argument('--profile', dest='profile', default=None, metavar='FILE',
+                    help=h)
+
+    h = 'Writes cProfile statistics of the run to a file.'
+    ap.add_argument('--cprofile', dest='cprofile', default=None,
+                    metavar='FILE', help=h)
+
+    h = 'Starts a server on a Unix socket that keeps the transducers loaded '
+    h += 'and runs the tests sent to it with --connect.'
+    ap.add_argument('--serve', dest='serve', default=None, metavar='SOCKET',
+                    help=h)
+
+    h = 'Runs the tests on the server listening on a Unix socket.'
+    ap.add_argument('--connect', dest='connect', default=None,
+                    metavar='SOCKET', help=h)
+
     ap.add_argument('-v', '--verbose', dest='verbose', action='store_true', 
                     help='More verbose output.')
     
-    ap.add_argument('test_file', help='YAML file with test rules')
-    arguments = ap.parse_args()
+    h = 'YAML files with test rules, or glob patterns matching them. Files '
+    h += 'using the same transducers share their loads and lookups.'
+    ap.add_argument('test_files', nargs='*', metavar='test_file', help=h)
+    arguments = ap.parse_args(argv)
+    if not arguments.test_files and not arguments.serve:
+      ap.error('the following arguments are required: test_file')
+    if arguments.shard:
+      # kept as a (number, count) tuple, numbered from 1
+      try: 
+        number, count = [int(n) for n in arguments.shard.split('/')]
+        if not 1 <= number <= count: raise ValueError
+      except ValueError: ap.error('--shard should be I/N, with 1 <= I <= N')
+      arguments.shard = (number, count)
+    if arguments.max_failures is not None and arguments.max_failures < 1:
+      ap.error('--max-failures should be at least 1')
+    # the server runs the tests with its own standard input, not the client's
+    if arguments.connect and '-' in (arguments.coverage, arguments.word_list):
+      ap.error('standard input ("-") can\'t be read with --connect')
+    # the limits are checked the same way as the ones in "Config" they replace
+    if arguments.max_results is not None and arguments.max_results <= 0:
+      error_checking(14)
+    if arguments.time_limit is not None and not arguments.time_limit > 0:
+      error_checking(14)
     return arguments
 
+def expand_test_files(patterns):
+    # patterns that don't match anything are kept, so opening them fails
+    files = []
+    for pattern in patterns:
+      matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else []
+      files.extend(matches or [pattern])
+    return files
+
 def define_colors():
     colors = {}
     colors['red'] = '\033[0;31m'
     colors['green'] = '\033[0;32m'
     colors['grey'] = '\033[0;37m'
+    colors['yellow'] = '\033[0;33m'
     colors['reset'] = '\033[m'
     return colors
 
-# Courtesy of https://gist.github.com/844388. Thanks!
-class _OrderedDictYAMLLoader(yaml.Loader):
-    """A YAML loader that loads mappings into ordered dictionaries."""
+_yaml_loaders = {}
 
-    def __init__(self, *args, **kwargs):
-        yaml.Loader.__init__(self, *args, **kwargs)
+def yaml_loaders():
+    """
+    Returns the ordered loader and the section loader, which subclass yaml's
+    own loaders, so they are only defined the first time a file is parsed.
+    """
+    if _yaml_loaders: return _yaml_loaders['ordered'], _yaml_loaders['section']
+    import yaml
 
-        self.add_constructor('tag:yaml.org,2002:map', type(self).construct_yaml_map)
-        self.add_constructor('tag:yaml.org,2002:omap', type(self).construct_yaml_map)
+    # Courtesy of https://gist.github.com/844388. Thanks!
+    class _OrderedDictYAMLLoader(yaml.Loader):
+        """A YAML loader that loads mappings into ordered dictionaries."""
 
-    def construct_yaml_map(self, node):
-        data = OrderedDict()
-        yield data
-        value = self.construct_mapping(node)
-        data.update(value)
+        def __init__(self, *args, **kwargs):
+            yaml.Loader.__init__(self, *args, **kwargs)
 
-    def construct_mapping(self, node, deep=False):
-        if isinstance(node, yaml.MappingNode):
-            self.flatten_mapping(node)
-        else:
-            raise yaml.constructor.ConstructorError(None, None,
-                'expected a mapping node, but found %s' % node.id, node.start_mark)
+            self.add_constructor('tag:yaml.org,2002:map', type(self).construct_yaml_map)
+            self.add_constructor('tag:yaml.org,2002:omap', type(self).construct_yaml_map)
+
+        def construct_yaml_map(self, node):
+            data = OrderedDict()
+            yield data
+            value = self.construct_mapping(node)
+            data.update(value)
+
+        def construct_mapping(self, node, deep=False):
+            if isinstance(node, yaml.MappingNode):
+                self.flatten_mapping(node)
+            else:
+                raise yaml.constructor.ConstructorError(None, None,
+                    'expected a mapping node, but found %s' % node.id, node.start_mark)
+
+            mapping = OrderedDict()
+            for key_node, value_node in node.value:
+                key = self.construct_object(key_node)
+                value = self.construct_object(value_node)
+                mapping[key] = value
+            return mapping
+
+    # the same loader on top of libyaml's C parser, which is many times faster
+    class _OrderedDictCLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+        """A libyaml based loader that loads mappings into ordered dictionaries."""
+
+        construct_yaml_map = _OrderedDictYAMLLoader.construct_yaml_map
+        construct_mapping = _OrderedDictYAMLLoader.construct_mapping
+
+    _OrderedDictCLoader.add_constructor('tag:yaml.org,2002:map',
+                                        _OrderedDictCLoader.construct_yaml_map)
+    _OrderedDictCLoader.add_constructor('tag:yaml.org,2002:omap',
+                                        _OrderedDictCLoader.construct_yaml_map)
 
-        mapping = OrderedDict()
-        for key_node, value_node in node.value:
-            key = self.construct_object(key_node)
-            value = self.construct_object(value_node)
-            mapping[key] = value
-        return mapping
+    class _SectionLoader(yaml.composer.Composer, _OrderedDictCLoader):
+        """A loader that can be driven one node at a time."""
+
+        def __init__(self, stream):
+            _OrderedDictCLoader.__init__(self, stream)
+            yaml.composer.Composer.__init__(self)
+
+        def next_object(self):
+            return self.construct_document(self.compose_node(None, None))
+
+    _yaml_loaders['ordered'] = _OrderedDictCLoader
+    _yaml_loaders['section'] = _SectionLoader
+    return _OrderedDictCLoader, _SectionLoader
 
 def yaml_load_ordered(f):
-    return yaml.load(f, _OrderedDictYAMLLoader)
+    import yaml
+    return yaml.load(f, yaml_loaders()[0])
+
+def yaml_load_sections(data):
+    """
+    Parses a test file a piece at a time. Yields (key, None, value) for each
+    top-level entry, except that a "Tests" mapping is yielded one section at
+    a time as ('Tests', title, mapping), as soon as each section is parsed.
+    """
+    import yaml
+    loader = yaml_loaders()[1](data)
+    try:
+      loader.get_event() # stream start
+      if loader.check_event(yaml.StreamEndEvent): return
+      loader.get_event() # document start
+      if not loader.check_event(yaml.MappingStartEvent):
+        yield None, None, loader.next_object()
+        return
+      loader.get_event()
+      while not loader.check_event(yaml.MappingEndEvent):
+        key = loader.next_object()
+        if key == 'Tests' and loader.check_event(yaml.MappingStartEvent):
+          loader.get_event()
+          while not loader.check_event(yaml.MappingEndEvent):
+            title = loader.next_object()
+            yield key, title, loader.next_object()
+          loader.get_event()
+        else: yield key, None, loader.next_object()
+    finally: loader.dispose()
 
 class MorphTest:
     """
     Holds information about each direction of a particular morphological test.
     """
+    # there can be millions of tests, so they are kept as small as possible
+    __slots__ = ('left', 'direction', 'right', 'hide_passes', 
+                 'ana_result', 'gen_result', 'verdict',
+                 'ana_tn', 'ana_fp', 'ana_missing', 'ignore_ana_fp',
+                 'gen_tn', 'gen_fp', 'gen_missing', 'ignore_gen_fp')
+
     def __init__(self, left, right, direction):
-        self.left = left
-        self.direction = direction 
-        self.right = right
+        # the same forms show up in many tests, interning stores them once
+        self.left = sys.intern(left) if isinstance(left, str) else left
+        self.direction = sys.intern(direction) 
+        self.right = sys.intern(right) if isinstance(right, str) else right
         self.hide_passes = False
 
-        # these will be added when running the tests
-        self.ana_result = []
-        self.gen_result = []
+        # these will be added when running the tests, results are tuples
+        # shared by all the tests with the same form
+        self.ana_result = ()
+        self.gen_result = ()
+
+        # worked out once by Results.evaluate(), see the *_bit flags
+        self.verdict = failed_bit
       
         # used for determining if test passed analysis
         self.ana_tn = True
-        self.ana_fp = []
+        self.ana_fp = ()
         self.ana_missing = True
         self.ignore_ana_fp = False
 
         # used for determining if test passed generation
         self.gen_tn = True
-        self.gen_fp = []
+        self.gen_fp = ()
         self.gen_missing = True
         self.ignore_gen_fp = False
 
+    def limited_analysis(self):
+        # was the analysis lookup cut short by a limit?
+        return isinstance(self.ana_result, LimitedOutputs)
+
+    def limited_generation(self):
+        return isinstance(self.gen_result, LimitedOutputs)
+
+    def failed(self):
+        # did either direction fail? directions cut short by a limit didn't
+        return bool(self.verdict & failed_bit)
+
     def passed_analysis(self):
-        # did analysis pass?
-        if not self.ana_missing and (self.ana_tn or self.ana_tn is None):
-          if self.ignore_ana_fp: return True
-          elif not len(self.ana_fp): return True
-        return False
+        # did analysis pass? a limited lookup can't tell
+        return bool(self.verdict & ana_passed_bit)
 
     def passed_generation(self):
         # did generation pass?
-        if not self.gen_missing and (self.gen_tn or self.gen_tn is None):
-          if self.ignore_gen_fp: return True
-          elif not len(self.gen_fp): return True
-        return False
+        return bool(self.verdict & gen_passed_bit)
 
     def get_test_results(self):
       """ 
@@ -166,7 +442,8 @@ class MorphTest:
   
       if not self.hide_passes or not self.passed_analysis():
         # analysis check mark
-        if self.passed_analysis(): s += pass_mark
+        if self.limited_analysis(): s += limit_mark
+        elif self.passed_analysis(): s += pass_mark
         else: s += fail_mark
         s += ' Analysis:' + ' '*25
 
@@ -198,7 +475,8 @@ class MorphTest:
 
       if not self.hide_passes or not self.passed_generation():
         # generation check mark
-        if self.passed_generation(): s += pass_mark
+        if self.limited_generation(): s += limit_mark
+        elif self.passed_generation(): s += pass_mark
         else: s += fail_mark
         s += ' Generation:' + ' '*23
       
@@ -230,9 +508,27 @@ class MorphTest:
       
       # comments
       if not self.passed_analysis() or not self.passed_generation(): 
-        c = ' Comments: {grey}'
+        c = ' Comments: {grey}' + self.get_comments() + '{reset}\n\n'
+
+        # formatting comments better 
+        c = textwrap.fill(c, 69)
+        c = c.replace('\n', '\n ')
+        c += '\n\n'
+
+      else: c = '\n' # if there are no comments
+      if self.hide_passes and self.passed_analysis() and self.passed_generation():
+        s, c = '', ''
+      return s + c
+
+    def get_comments(self):
+        """
+        Creates a plain string explaining why the test failed.
+        """
+        c = ''
         if not self.passed_analysis():
           # analysis:
+          if self.limited_analysis():
+            c += 'analysis of {} hit the lookup limit. '.format(self.right)
           if self.ana_missing: c += 'analysis is missing {}. '.format(self.left)
           if self.ana_tn == False: c += '{} was generated. '.format(self.right)
           if len(self.ana_fp):
@@ -246,6 +542,8 @@ class MorphTest:
         
         if not self.passed_generation():
           #generation:
+          if self.limited_generation():
+            c += 'generation of {} hit the lookup limit. '.format(self.left)
           if self.gen_missing: 
             c += 'generation is missing {}. '.format(self.right)
           if self.gen_tn == False: c += '{} was analyzed. '.format(self.left)
@@ -257,58 +555,93 @@ class MorphTest:
                 c += '{}, '.format(generation)
               c += 'and {}.'.format(self.gen_fp[-1])
             elif len(self.gen_fp) == 1: c += ': {}.'.format(self.gen_fp[0])
-        c += '{reset}\n\n'
+        return c
 
-        # formatting comments better 
-        c = textwrap.fill(c, 69)
-        c = c.replace('\n', '\n ')
-        c += '\n\n'
+    def get_record(self, direction):
+        """
+        Passed, TP, TN, FP and FN of one direction ('ana' or 'gen'), with the
+        same True (passed), False (failed) or None (N/A) as the normal output.
+        """
+        if direction == 'ana':
+          passed = self.passed_analysis()
+          missing, tn, fp = self.ana_missing, self.ana_tn, self.ana_fp
+          results = self.ana_result
+          ignore_fp = self.ignore_ana_fp
+        else:
+          passed = self.passed_generation()
+          missing, tn, fp = self.gen_missing, self.gen_tn, self.gen_fp
+          results = self.gen_result
+          ignore_fp = self.ignore_gen_fp
+        record = OrderedDict()
+        record['passed'] = passed
+        record['limited'] = isinstance(results, LimitedOutputs)
+        record['tp'] = None if missing is None else not missing
+        record['tn'] = None if tn is None else bool(tn)
+        record['fp'] = None if ignore_fp else not fp
+        record['fn'] = record['tp']
+        record['unexpected'] = list(fp)
+        return record
 
-      else: c = '\n' # if there are no comments
-      if self.hide_passes and self.passed_analysis() and self.passed_generation():
-        s, c = '', ''
-      return s + c
+def test_triples(mappings):
+    """
+    Returns a (left, right, direction) tuple for each test in the mappings of
+    a section, checking the directions.
+    """
+    triples = []
+    # for each 'left (direction) right' mapping:
+    for left in mappings:
+      for map_direction, right in mappings[left].items():
+        # there can be one item or a list of them
+        if not isinstance(right, list): right = [right]
+        for item in right:
+          if map_direction not in ['=>', '<=', '<=>']: error_checking(6)
+          triples.append((left, item, map_direction))
+    return triples
+
+def add_section(sections, number, title, triples):
+    """
+    Adds a section parsed by parse_test_file() to sections and returns it. A
+    repeated title replaces the tests of the earlier section instead.
+    """
+    tests = [MorphTest(left, right, direction) 
+             for left, right, direction in triples]
+    if number < len(sections): 
+      section = sections[number]
+      section.tests = tests
+    else:
+      section = Section(title, number, None, tests)
+      sections.append(section)
+    return section
 
 class Section:
     """
     Holds information about the tests in a particular section of the .yaml file.
     """
-    def __init__(self, title, number, mappings):
+    def __init__(self, title, number, mappings, tests=None):
         self.title = title
         self.number = number
         self.mappings = mappings 
-        self.tests = self.populate_tests()
+        # tests loaded from the cache don't need to be populated again
+        if tests is None: tests = self.populate_tests()
+        self.tests = tests
         self.ana_passes, self.ana_fails = 0, 0
         self.gen_passes, self.gen_fails = 0, 0
+        self.ana_limited, self.gen_limited = 0, 0
+
+    def first(self, n):
+        # a copy with only the first n tests, for a run stopped part way
+        section = Section(self.title, self.number, None, self.tests[:n])
+        section.ana_passes, section.ana_fails = self.ana_passes, self.ana_fails
+        section.gen_passes, section.gen_fails = self.gen_passes, self.gen_fails
+        section.ana_limited = self.ana_limited
+        section.gen_limited = self.gen_limited
+        return section
 
     def populate_tests(self):
-        tests = []
-        # for each 'left (direction) right' mapping:
-        for left in self.mappings:
-          for map_direction, right in self.mappings[left].items():
-            # if there are multiple items
-            if isinstance(right, list):
-              for item in right:
-                if map_direction in ['=>', '<=', '<=>']:
-                  tests.append(MorphTest(left, item, map_direction))
-                else: error_checking(6)
-            # if there is only one item
-            else:
-              if map_direction in ['=>', '<=', '<=>']:
-                  tests.append(MorphTest(left, right, map_direction))
-              else: error_checking(6)
-       
-        return tests 
-
-    def get_counts(self):
-        # gets section's pass count and fail count for analysis and generation
-        for test in self.tests:
-          if test.passed_analysis(): self.ana_passes += 1
-          else: self.ana_fails += 1
-          if test.passed_generation(): self.gen_passes += 1
-          else: self.gen_fails += 1
-    
-    def create_output(self, normal_style=True):
+        return [MorphTest(left, right, direction) 
+                for left, right, direction in test_triples(self.mappings)]
+
+    def create_header(self, normal_style=True):
         # this function is only used for normal or compact style output
         # make section header into a string
         s = '{grey}-'*80 + '{reset}\n'
@@ -316,264 +649,1814 @@ class Section:
         if normal_style: s += 'True pos    True neg   False pos   False neg\n'
         else: s += ' '*46 # compact
         s += '{grey}-'*80 + '{reset}\n'
- 
-        # normal output style
-        if normal_style:
-          # make test results into strings
-          for test in self.tests:
-            s += test.get_test_results()
-        
+        return s
+
+    def create_counts(self, normal_style=True):
         # make passes and fails counts into strings
+        s = ''
         if not normal_style: # compact
           if self.ana_fails: s += '{} '.format(fail_mark)
+          elif self.ana_limited: s += '{} '.format(limit_mark)
           else: s += '{} '.format(pass_mark)
 
         s += 'Analysis - {}: {}, '.format(pass_mark, self.ana_passes)
         s += '{}: {}'.format(fail_mark, self.ana_fails)
+        if self.ana_limited: 
+          s += ', {}: {}'.format(limit_mark, self.ana_limited)
 
         if normal_style: s += ' / ' # same line if normal 
         else:  # compact
           if self.gen_fails: s += '\n{} '.format(fail_mark)
+          elif self.gen_limited: s += '\n{} '.format(limit_mark)
           else: s += '\n{} '.format(pass_mark)
 
         s += 'Generation - {}: {}, '.format(pass_mark, self.gen_passes)
-        s += '{}: {}\n\n'.format(fail_mark, self.gen_fails)
+        s += '{}: {}'.format(fail_mark, self.gen_fails)
+        if self.gen_limited: 
+          s += ', {}: {}'.format(limit_mark, self.gen_limited)
+        s += '\n\n'
         
         return s
 
+def create_final(counts):
+    """
+    Makes the overall passes and fails into a string. counts is anything 
+    with the counters of a Section, like Results.
+    """
+    s = 'Overall results:\n'
+    if counts.ana_fails: s += ' {} '.format(fail_mark)
+    elif counts.ana_limited: s += ' {} '.format(limit_mark)
+    else: s += ' {} '.format(pass_mark)
+
+    s += 'Analysis - {}: {}, '.format(pass_mark, counts.ana_passes)
+    s += '{}: {}'.format(fail_mark, counts.ana_fails)
+    if counts.ana_limited: 
+      s += ', {}: {}'.format(limit_mark, counts.ana_limited)
+
+    if counts.gen_fails: s += '\n {} '.format(fail_mark)
+    elif counts.gen_limited: s += '\n {} '.format(limit_mark)
+    else: s += '\n {} '.format(pass_mark)
+
+    s += 'Generation - {}: {}, '.format(pass_mark, counts.gen_passes)
+    s += '{}: {}'.format(fail_mark, counts.gen_fails)
+    if counts.gen_limited: 
+      s += ', {}: {}'.format(limit_mark, counts.gen_limited)
+    return s
+
+def cache_directory(args):
+    if args.cache_dir: return args.cache_dir
+    test_dir = os.path.dirname(os.path.abspath(args.test_files[0]))
+    return os.path.join(test_dir, '.morph-test-cache')
+
+def cache_name(test_file, kind):
+    # what is kept for a test file is named after its absolute path too, 
+    # as test files in different directories can have the same name
+    path = os.path.abspath(test_file).encode('utf-8')
+    return '{}.{}.{}'.format(os.path.basename(test_file), 
+                             hashlib.sha1(path).hexdigest()[:16], kind)
+
+_file_hashes = {}
+
+def file_hash(path):
+    """
+    Returns the sha1 hex digest of a file's contents. Digests are remembered
+    for as long as the file's size and modification time stay the same.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+      digest = hashlib.sha1()
+      with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+          digest.update(block)
+      _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+def read_transducer(path):
+    """
+    Reads the transducer in a file. Whatever libhfst raises for a file that
+    can't be read is raised as an OSError.
+    """
+    import libhfst
+    try: return libhfst.HfstInputStream(path).read()
+    except Exception as e: raise OSError('{}: {}'.format(path, e)) from e
+
+def optimized_transducer(path, args):
+    """
+    Returns the path of an optimized-lookup version of the transducer. The 
+    conversion is only done once, the result is cached under the hash of the 
+    original file. Raises OSError when the transducer can't be read.
+    """
+    import libhfst
+    ol_types = (libhfst.ImplementationType.HFST_OL_TYPE,
+                libhfst.ImplementationType.HFST_OLW_TYPE)
+    weighted_types = (libhfst.ImplementationType.TROPICAL_OPENFST_TYPE,
+                      libhfst.ImplementationType.LOG_OPENFST_TYPE)
+    try: file_type = libhfst.HfstInputStream(path).get_type()
+    except Exception as e: raise OSError('{}: {}'.format(path, e)) from e
+    if file_type in ol_types: return path
+
+    name = '{}.{}.ol.hfst'.format(os.path.basename(path), file_hash(path))
+    cached = os.path.join(cache_directory(args), name)
+    if os.path.exists(cached): return cached
+    if args.verbose: print('Converting {} to optimized-lookup.'.format(path))
+
+    transducer = read_transducer(path)
+    if transducer.get_type() in weighted_types:
+      transducer.convert(libhfst.ImplementationType.HFST_OLW_TYPE)
+    else: transducer.convert(libhfst.ImplementationType.HFST_OL_TYPE)
+
+    # written under a temporary name first so other runs never see half a file
+    os.makedirs(cache_directory(args), exist_ok=True)
+    temporary = '{}.{}.tmp'.format(cached, os.getpid())
+    transducer.write_to_file(temporary)
+    os.replace(temporary, cached)
+    return cached
+
+def lookup_limits(args, config=(None, None)):
+    # the limits given on the command line win over the ones in "Config"
+    max_results, time_limit = config
+    if args.max_results is not None: max_results = args.max_results
+    if args.time_limit is not None: time_limit = args.time_limit
+    return max_results or None, time_limit or None
+
+class LimitedOutputs(tuple):
+    """
+    The outputs of a lookup that was cut short by --max-results or 
+    --time-limit, so there may be more outputs than these.
+    """
+    __slots__ = ()
+
+def lookup_outputs(transducer, string, limits=(None, None)):
+    max_results, time_limit = limits
+    if not max_results and not time_limit:
+      return tuple(result[0] for result in transducer.lookup(string))
+
+    # one result more than the limit tells if there were too many
+    kwargs = {}
+    if max_results: kwargs['max_number'] = max_results + 1
+    if time_limit: kwargs['time_cutoff'] = time_limit
+    start = time.perf_counter()
+    outputs = tuple(result[0] for result in transducer.lookup(string, **kwargs))
+    if max_results and len(outputs) > max_results:
+      return LimitedOutputs(outputs[:max_results])
+    if time_limit and time.perf_counter() - start >= time_limit:
+      return LimitedOutputs(outputs)
+    return outputs
+
+def flags_allow(flags):
+    """
+    Tells if the flag diacritics met along a path, in order, let it through
+    the way lookup obeys them. A feature's value is None while unset, and 
+    (False, value) after @N.F.V@ set it to anything but value.
+    """
+    values = {}
+    for flag in flags:
+      parts = flag[1:-1].split('.')
+      operator, feature = parts[0], parts[1]
+      value = parts[2] if len(parts) > 2 else None
+      current = values.get(feature)
+      if operator == 'P': values[feature] = (True, value)
+      elif operator == 'N': values[feature] = (False, value)
+      elif operator == 'C': values.pop(feature, None)
+      elif operator == 'R':
+        if value is None and current is None: return False
+        if value is not None and current != (True, value): return False
+      elif operator == 'D':
+        if value is None and current is not None: return False
+        if value is not None and current == (True, value): return False
+      elif operator == 'U':
+        if current is None or current == (True, value) or \
+        (not current[0] and current[1] != value): 
+          values[feature] = (True, value)
+        else: return False
+    return True
+
+def compose_lookup(transducer, strings, max_results=None):
+    """
+    Looks up all the strings at once: an acceptor of the strings is composed
+    with the transducer, whose paths then give the outputs of each string. 
+    The transducer must be in a type that can be composed, see composable().
+    The outputs are the ones lookup would give, in the same order.
+    """
+    import libhfst
+    # strings are split into symbols the way the transducer would read them
+    tokenizer = libhfst.HfstTokenizer()
+    flags = []
+    for symbol in transducer.get_alphabet():
+      if len(symbol) > 1 and not symbol.startswith('@_'):
+        tokenizer.add_multichar_symbol(symbol)
+      if libhfst.is_diacritic(symbol): flags.append(symbol)
+    def compose(strings):
+      acceptor = libhfst.HfstBasicTransducer()
+      for string in strings:
+        symbols = tokenizer.tokenize_one_level(string)
+        acceptor.disjunct(tuple((symbol, symbol) for symbol in symbols), 0)
+      # lookup reads flag diacritics without any input, so the acceptor lets
+      # them through anywhere
+      for state in acceptor.states():
+        for flag in flags:
+          loop = libhfst.HfstBasicTransition(state, flag, flag, 0)
+          acceptor.add_transition(state, loop)
+      composed = libhfst.HfstTransducer(acceptor, transducer.get_type())
+      composed.compose(transducer)
+      return composed
+
+    composed = compose(strings)
+    # each path gives its output as lookup would, one symbol per transition 
+    # with epsilons as '', flags are checked here since libhfst would leave 
+    # them out, and cycles are not followed
+    epsilon = '@_EPSILON_SYMBOL_@'
+    flags = set(flags)
+    outputs = {}
+    for weight, path in composed.extract_paths(output='raw', max_cycles=0,
+                                               obey_flags=False, 
+                                               filter_flags=False):
+      if flags and not flags_allow([o for i, o in path if o in flags]): 
+        continue
+      string = ''.join(i for i, o in path if i != epsilon and i not in flags)
+      symbols = tuple('' if o == epsilon else o for i, o in path)
+      outputs.setdefault(string, set()).add((weight, symbols))
+    # strings with a path through a cycle have outputs that were cut off
+    cyclic = set()
+    if composed.is_cyclic():
+      cyclic = set(string for string in strings 
+                   if compose([string]).is_cyclic())
+    results = []
+    for string in strings:
+      # lookup orders its outputs by weight and then by symbols
+      found = tuple(''.join(symbols) for weight, symbols in 
+                    sorted(outputs.get(string, ())))
+      if max_results and len(found) > max_results:
+        found = LimitedOutputs(found[:max_results])
+      elif string in cyclic: found = LimitedOutputs(found)
+      results.append(found)
+    return results
+
+def process_context():
+    # once the run has threads (reading transducers, running a pool), they
+    # could hold locks that a fork would copy in their locked state, so 
+    # processes are then forked by a server process that has no threads
+    import multiprocessing
+    if threading.active_count() == 1: return multiprocessing.get_context()
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['__main__'])
+    return context
+
+# transducer and limits used by a worker process of the lookup pool
+_worker_transducer = None
+_worker_limits = (None, None)
+_worker_error = None
+
+def init_worker(path, limits=(None, None)):
+    # a worker that dies here is only replaced by one that dies the same way,
+    # so an unreadable transducer is reported by the first lookup instead
+    global _worker_transducer, _worker_limits, _worker_error
+    try: _worker_transducer = read_transducer(path)
+    except OSError as e: _worker_error = str(e)
+    _worker_limits = limits
+
+def lookup_chunk(strings):
+    if _worker_error: raise OSError(_worker_error)
+    return [lookup_outputs(_worker_transducer, string, _worker_limits) 
+            for string in strings]
+
+def lookup_timed(transducer, strings, limits=(None, None)):
+    # returns the outputs of each string along with how long its lookup took
+    timed = []
+    for string in strings:
+      start = time.perf_counter()
+      outputs = lookup_outputs(transducer, string, limits)
+      timed.append((outputs, time.perf_counter() - start))
+    return timed
+
+def lookup_chunk_timed(strings):
+    if _worker_error: raise OSError(_worker_error)
+    return lookup_timed(_worker_transducer, strings, _worker_limits)
+
+def percentiles(values):
+    # latency summary in milliseconds
+    if not values: return OrderedDict()
+    values = sorted(values)
+    summary = OrderedDict()
+    for p in [50, 90, 99]:
+      summary['p{}'.format(p)] = values[(len(values) - 1) * p // 100] * 1000
+    summary['max'] = values[-1] * 1000
+    summary['mean'] = sum(values) / len(values) * 1000
+    return summary
+
+class Profiler:
+    """
+    Records the wall and CPU time of each phase of a run, and the lookups done
+    for each section. Does nothing unless it is enabled.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = (time.perf_counter(), time.process_time())
+        self.phases = OrderedDict()
+        self.sections = []
+        self.latencies = []
+        # phases can be nested, time spent in an inner phase only counts there
+        self.stack = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+          yield
+          return
+        if threading.current_thread() is not threading.main_thread():
+          # phases running in the background overlap with the main thread's
+          with self.background_phase(name): yield
+          return
+        self.stack.append([0.0, 0.0])
+        wall, cpu = time.perf_counter(), time.process_time()
+        try: yield
+        finally:
+          wall = time.perf_counter() - wall
+          cpu = time.process_time() - cpu
+          inner_wall, inner_cpu = self.stack.pop()
+          totals = self.phases.setdefault(name, [0.0, 0.0])
+          totals[0] += wall - inner_wall
+          totals[1] += cpu - inner_cpu
+          if self.stack:
+            self.stack[-1][0] += wall
+            self.stack[-1][1] += cpu
+
+    @contextmanager
+    def background_phase(self, name):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try: yield
+        finally: self.add_phase(name, time.perf_counter() - wall,
+                                time.thread_time() - cpu)
+
+    def add_phase(self, name, wall, cpu):
+        # time spent in other threads or processes
+        if not self.enabled: return
+        with self.lock:
+          totals = self.phases.setdefault(name, [0.0, 0.0])
+          totals[0] += wall
+          totals[1] += cpu
+
+    def add_section(self, section, requested, performed, cached, latencies):
+        if not self.enabled: return
+        self.latencies.extend(latencies)
+        record = OrderedDict()
+        record['number'] = section.number
+        record['title'] = section.title
+        record['tests'] = len(section.tests)
+        record['lookups'] = requested
+        record['unique_lookups'] = performed
+        record['cached_lookups'] = cached
+        record['latency_ms'] = percentiles(latencies)
+        self.sections.append(record)
+
+    def write(self, path):
+        profile = OrderedDict()
+        profile['wall'] = time.perf_counter() - self.start[0]
+        profile['cpu'] = time.process_time() - self.start[1]
+        profile['phases'] = OrderedDict((name, {'wall': wall, 'cpu': cpu})
+                                        for name, (wall, cpu)
+                                        in self.phases.items())
+        profile['lookups'] = len(self.latencies)
+        profile['latency_ms'] = percentiles(self.latencies)
+        profile['sections'] = self.sections
+        with open(path, 'w') as f:
+          json.dump(profile, f, indent=2)
+          f.write('\n')
+
+class LookupCache:
+    """
+    Keeps lookup results between runs in an SQLite file. Results are stored
+    under the hash of the transducer, the direction and the input string, so
+    they are never used for a transducer that has changed.
+    """
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.now = int(time.time())
+        import sqlite3
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS lookups (fst TEXT, '
+                        'direction TEXT, input TEXT, outputs TEXT, '
+                        'used INTEGER, PRIMARY KEY (fst, direction, input))')
+
+    def get(self, fst, direction, strings):
+        # returns a dictionary with the strings that were found in the cache
+        found = {}
+        query = 'SELECT input, outputs FROM lookups WHERE fst = ? AND '
+        query += 'direction = ? AND input IN ({})'
+        for i in range(0, len(strings), 500):
+          chunk = strings[i:i+500]
+          rows = self.db.execute(query.format(','.join('?' * len(chunk))),
+                                 [fst, direction] + chunk)
+          for string, outputs in rows:
+            found[string] = tuple(json.loads(outputs))
+
+        # marking the entries as used, for eviction
+        self.db.executemany('UPDATE lookups SET used = ? WHERE fst = ? AND '
+                            'direction = ? AND input = ?',
+                            [(self.now, fst, direction, string) 
+                             for string in found])
+        self.db.commit()
+        return found
+
+    def put(self, fst, direction, results):
+        # results cut short by a limit are not kept, a run without the limit
+        # must not take them for complete
+        results = [(string, outputs) for string, outputs in results
+                   if not isinstance(outputs, LimitedOutputs)]
+        self.db.executemany('INSERT OR REPLACE INTO lookups VALUES '
+                            '(?, ?, ?, ?, ?)',
+                            [(fst, direction, string, json.dumps(outputs),
+                              self.now) for string, outputs in results])
+        self.db.commit()
+
+    def close(self):
+        # least recently used entries are dropped when the cache is too big
+        count = self.db.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+        if count > self.max_entries:
+          self.db.execute('DELETE FROM lookups WHERE rowid IN (SELECT rowid '
+                          'FROM lookups ORDER BY used LIMIT ?)',
+                          (count - self.max_entries,))
+          self.db.commit()
+        self.db.close()
+
+class ResidentTransducers:
+    """
+    Keeps transducers loaded between the runs of a server. A transducer is only
+    read again when its file changes.
+    """
+    def __init__(self):
+        self.loaded = {}
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if path not in self.loaded or self.loaded[path][0] != key:
+          self.loaded[path] = (key, read_transducer(path))
+        return self.loaded[path][1]
+
+class LookupEngine:
+    """
+    Looks up strings in the analyzer and generator. Each unique string is only
+    looked up once per transducer, no matter how many tests it appears in.
+    """
+    def __init__(self, morph, gen, args, profiler=None, resident=None,
+                 limits=(None, None), cache=True):
+        self.paths = {'ana': morph, 'gen': gen}
+        self.sources = {'ana': morph, 'gen': gen}
+        self.args = args
+        self.limits = limits
+        self.transducers = {}
+        self.composables = {}
+        self.resident = resident
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.profiler = profiler or Profiler()
+        self.latencies = []
+        self.cache = None
+        if cache and not args.no_cache:
+          os.makedirs(cache_directory(args), exist_ok=True)
+          path = os.path.join(cache_directory(args), 'lookups.sqlite')
+          self.cache = LookupCache(path, args.cache_size)
+
+        # lookup results of every string seen so far, for each direction
+        self.results = {'ana': {}, 'gen': {}}
+        self.requested = 0
+        self.performed = 0
+        self.cached = 0
+
+    def path(self, direction):
+        # with --optimize, the path of the converted transducer is used instead,
+        # as it is with a time limit, which libhfst only keeps in that format
+        timed = self.limits[1] and self.args.backend == 'lookup'
+        if self.args.optimize or timed:
+          self.paths[direction] = optimized_transducer(self.paths[direction],
+                                                       self.args)
+        return self.paths[direction]
+
+    def transducer(self, direction):
+        # transducers are only read once, when they are first needed or by 
+        # preload(), the lock makes lookups wait for a read in progress
+        with self.lock:
+          if direction not in self.transducers:
+            with self.profiler.phase('transducer_load'):
+              path = self.path(direction)
+              if self.resident: 
+                self.transducers[direction] = self.resident.get(path)
+              else: self.transducers[direction] = read_transducer(path)
+        return self.transducers[direction]
+
+    def composable(self, direction):
+        # a copy of the transducer that can be composed, for --backend compose
+        transducer = self.transducer(direction)
+        with self.lock:
+          if direction not in self.composables:
+            with self.profiler.phase('transducer_load'):
+              import libhfst
+              composable = libhfst.HfstTransducer(transducer)
+              composable.convert(
+                libhfst.ImplementationType.TROPICAL_OPENFST_TYPE)
+              self.composables[direction] = composable
+        return self.composables[direction]
+
+    def preload(self):
+        # starts reading both transducers in the background
+        for direction in ['ana', 'gen']:
+          if self.args.jobs > 1 and self.args.backend == 'lookup': 
+            # the pool's workers start reading their copies right away, errors
+            # are raised again when the pool is needed for a lookup
+            try: self.pool(direction)
+            except OSError: pass
+          else:
+            thread = threading.Thread(target=self.try_transducer,
+                                      args=(direction,), daemon=True)
+            thread.start()
+
+    def try_transducer(self, direction):
+        # errors are raised again when the transducer is needed for a lookup,
+        # and only reported from there
+        try: 
+          if self.args.backend == 'compose': self.composable(direction)
+          else: self.transducer(direction)
+        except Exception: pass
+
+    def lookup(self, direction, strings):
+        """
+        Returns a dictionary mapping each of the strings to a tuple with its
+        lookup results. Strings that were already looked up are not redone.
+        direction: 'ana' for the analyzer or 'gen' for the generator
+        """
+        self.requested += len(strings)
+        return self.prefetch(direction, strings)
+
+    def prefetch(self, direction, strings):
+        # the lookups of lookup(), without counting the strings as requested,
+        # a transducer that can't be read here or by the pool's workers is
+        # reported once, by the thread that asked for the lookups
+        try: return self.fetch(direction, strings)
+        except OSError: error_checking(9)
+
+    def fetch(self, direction, strings):
+        results = self.results[direction]
+        unique = []
+        for string in strings:
+          if string not in results:
+            results[string] = None
+            unique.append(string)
+
+        if self.cache and unique:
+          # strings looked up by an earlier run don't need libhfst at all
+          fst = file_hash(self.sources[direction])
+          found = self.cache.get(fst, direction, unique)
+          max_results = self.limits[0]
+          if max_results:
+            # complete results from the cache still have to respect the limit
+            found = {string: LimitedOutputs(outputs[:max_results]) 
+                     if len(outputs) > max_results else outputs
+                     for string, outputs in found.items()}
+          results.update(found)
+          self.cached += len(found)
+          unique = [string for string in unique if string not in found]
+
+        new = list(zip(unique, self.lookup_all(direction, unique)))
+        results.update(new)
+        if self.cache and new: self.cache.put(fst, direction, new)
+        self.performed += len(unique)
+        return results
+
+    def pool(self, direction):
+        # each worker process loads its own copy of the transducer
+        if direction not in self.pools:
+          path = self.path(direction)
+          self.pools[direction] = process_context().Pool(self.args.jobs,
+                                    initializer=init_worker, 
+                                    initargs=(path, self.limits))
+        return self.pools[direction]
+
+    def lookup_all(self, direction, strings):
+        # does the actual lookups, in the same order as the strings
+        if not strings: return []
+        if self.args.backend == 'compose':
+          # there are no per-string latencies to keep for the profiler
+          return compose_lookup(self.composable(direction), strings,
+                                self.limits[0])
+        if self.args.jobs > 1 and len(strings) > self.args.jobs:
+          # strings are split into chunks that are handed out to the workers,
+          # map() gives the chunks back in order so the output is the same
+          size = -(-len(strings) // (self.args.jobs * 4))
+          chunks = [strings[i:i+size] for i in range(0, len(strings), size)]
+          # workers that couldn't read the transducer fail every chunk
+          if self.profiler.enabled: 
+            results = self.pool(direction).map(lookup_chunk_timed, chunks)
+            return self.split_timed([t for chunk in results for t in chunk])
+          results = self.pool(direction).map(lookup_chunk, chunks)
+          return [outputs for chunk in results for outputs in chunk]
+
+        transducer = self.transducer(direction)
+        if self.profiler.enabled:
+          return self.split_timed(lookup_timed(transducer, strings, 
+                                               self.limits))
+        return [lookup_outputs(transducer, string, self.limits) 
+                for string in strings]
+
+    def split_timed(self, timed):
+        # keeps the latencies for the profiler and returns the outputs
+        self.latencies.extend(latency for outputs, latency in timed)
+        return [outputs for outputs, latency in timed]
+
+    def forget(self, direction):
+        # drops the results kept so far, for runs that only need them once
+        self.results[direction] = {}
+
+    def close(self):
+        for pool in self.pools.values():
+          pool.close()
+          pool.join()
+        self.pools = {}
+        if self.cache:
+          self.cache.close()
+          self.cache = None
+
+    def report(self):
+        saved = self.requested - self.performed - self.cached
+        s = 'Looked up {} unique strings for {} '.format(self.performed,
+                                                          self.requested)
+        s += 'requested lookups ({} lookups saved, '.format(saved)
+        s += '{} found in the cache).'.format(self.cached)
+        return s
+
+def find_section(sections, name):
+    # sections can be referred to by their number or their title, which 
+    # yaml may have read as a number too
+    for section in sections:
+      if name in (str(section.number), str(section.title)): return section
+    return None
+
+def in_shard(test, shard):
+    # the hash only depends on the test itself, not on the order of the file
+    key = '\0'.join(str(side) for side in (test.left, test.direction, test.right))
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard[1] == shard[0] - 1
+
+def select_sections(sections, args):
+    """
+    Returns the sections picked with --test, keeping only the tests that 
+    match a --filter. Sections left without tests are dropped.
+    """
+    selected = sections
+    if args.test:
+      selected = []
+      for name in args.test:
+        section = find_section(sections, name)
+        if section is None: error_checking(7)
+        if section not in selected: selected.append(section)
+
+    if args.shard:
+      for section in selected:
+        section.tests = [test for test in section.tests 
+                         if in_shard(test, args.shard)]
+      selected = [section for section in selected if section.tests]
+
+    if args.filter:
+      filters = []
+      for f in args.filter:
+        # the part before the first colon is a section if one has that name
+        section, regex = None, f
+        if ':' in f and find_section(sections, f.split(':', 1)[0]):
+          section = find_section(sections, f.split(':', 1)[0])
+          regex = f.split(':', 1)[1]
+        try: filters.append((section, re.compile(regex)))
+        except re.error: error_checking(10)
+
+      # forms yaml read as numbers or booleans are matched as strings
+      for section in selected:
+        section.tests = [test for test in section.tests
+                         if any((s is None or s is section) and 
+                                (r.search(str(test.left)) or 
+                                 r.search(str(test.right)))
+                                for s, r in filters)]
+      selected = [section for section in selected if section.tests]
+    return selected
+
+# bumped whenever the layout of baseline files changes
+baseline_version = 1
+
+def wanted_tests(section, args):
+    """
+    The tests of a section that --test and --filter could select, for looking
+    them up before the rest of the file is parsed. As the other sections are
+    not known yet, a filter's "SECTION:" prefix is read both ways.
+    """
+    if args.test and not (str(section.title) in args.test or 
+                          str(section.number) in args.test):
+      return []
+    tests = section.tests
+    if args.shard: tests = [test for test in tests if in_shard(test, args.shard)]
+    if not args.filter: return tests
+
+    regexes = []
+    for f in args.filter:
+      patterns = [f]
+      prefix = f.split(':', 1)[0]
+      if ':' in f and prefix in [str(section.title), str(section.number)]:
+        patterns.append(f.split(':', 1)[1])
+      for pattern in patterns:
+        try: regexes.append(re.compile(pattern))
+        except re.error: pass # reported by select_sections()
+    return [test for test in tests
+            if any(r.search(str(test.left)) or r.search(str(test.right)) 
+                   for r in regexes)]
+
+class Baseline:
+    """
+    Lookup results and pass/fail state of every test of a test file, as of an
+    earlier run. Tests that have not changed since then reuse its results.
+    """
+    def __init__(self, path, hashes):
+        self.path = path
+        self.hashes = hashes
+        self.old_hashes, self.tests = {}, {}
+        try:
+          with open(path, 'rb') as f: 
+            version, old_hashes, tests = marshal.load(f)
+          if version == baseline_version:
+            self.old_hashes, self.tests = old_hashes, tests
+        except: pass # there is no usable baseline yet
+        self.recorded = {}
+        self.reused = 0
+        self.changes = []
+
+    def results(self, test, direction):
+        # results of the test from the baseline, if neither it nor the 
+        # transducer have changed since
+        if self.old_hashes.get(direction) != self.hashes[direction]: return None
+        entry = self.tests.get((test.left, test.direction, test.right))
+        if entry is None: return None
+        return entry[0] if direction == 'ana' else entry[1]
+
+    def record(self, test):
+        # keeps the test's new state and notes if it passes or fails anew
+        # limited tests are looked up again next time, without any verdict
+        if test.limited_analysis() or test.limited_generation(): return
+        key = (test.left, test.direction, test.right)
+        passed = (test.passed_analysis(), test.passed_generation())
+        self.recorded[key] = (test.ana_result, test.gen_result) + passed
+        old = self.tests.get(key)
+        for i, direction in enumerate(['analysis', 'generation']):
+          if old is None and not passed[i]: 
+            self.changes.append((test, direction, False))
+          elif old is not None and old[2 + i] != passed[i]:
+            self.changes.append((test, direction, passed[i]))
+
+    def save(self, partial=False):
+        # a partial run only replaces the tests it ran, unless the transducers
+        # changed and the other tests' results are out of date
+        tests = self.recorded
+        if partial and self.old_hashes == self.hashes:
+          tests = dict(self.tests)
+          tests.update(self.recorded)
+        try:
+          os.makedirs(os.path.dirname(self.path), exist_ok=True)
+          temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+          with open(temporary, 'wb') as f:
+            marshal.dump((baseline_version, self.hashes, tests), f)
+          os.replace(temporary, self.path)
+        except (OSError, ValueError): error_checking(13)
+
+# bumped whenever the layout of history files changes
+history_version = 1
+
+class FailureHistory:
+    """
+    The tests of a test file that failed in its last few runs, so that they
+    can be run first.
+    """
+    # failures older than this many runs are forgotten
+    keep_runs = 20
+
+    def __init__(self, path):
+        self.path = path
+        self.run, self.failed = 0, {}
+        try:
+          with open(path, 'rb') as f: version, run, failed = marshal.load(f)
+          if version == history_version: self.run, self.failed = run, failed
+        except: pass # there is no usable history yet
+        self.run += 1
+
+    def priority(self, section):
+        # the number of the section's tests that failed recently
+        return sum(1 for test in section.tests 
+                   if (test.left, test.direction, test.right) in self.failed)
+
+    def last_failure(self, test):
+        # the last run in which the test failed, 0 if it didn't recently
+        return self.failed.get((test.left, test.direction, test.right), 0)
+
+    def record(self, test):
+        # tests are remembered by the last run in which they failed
+        key = (test.left, test.direction, test.right)
+        if test.failed(): self.failed[key] = self.run
+        else: self.failed.pop(key, None)
+
+    def save(self):
+        failed = {key: run for key, run in self.failed.items() 
+                  if self.run - run < self.keep_runs}
+        try:
+          os.makedirs(os.path.dirname(self.path), exist_ok=True)
+          temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+          with open(temporary, 'wb') as f:
+            marshal.dump((history_version, self.run, failed), f)
+          os.replace(temporary, self.path)
+        except (OSError, ValueError): pass # only used for scheduling
+
 class Results:
     """
     Performs the tests and holds the list of Sections. 
     """
-    def __init__(self, sections_list, morph, gen, args):
-        # these dictionaries help ensure false positives 
-        # are actually false positives
-        self.analysis_dict = {}
-        for section in sections_list:
-          for test in section.tests:
-            if test.right in self.analysis_dict:
-              self.analysis_dict[test.right].append(test.left)
-            else: self.analysis_dict[test.right] = [test.left]
-  
-        self.generation_dict = {}
-        for section in sections_list:
-          for test in section.tests:
-            if test.right in self.generation_dict:
-              self.analysis_dict[test.left].append(test.right)
-            else: self.generation_dict[test.left] = [test.right]
-        
+    # sizes of the batches tests are run in with --max-failures
+    first_batch = 16
+    last_batch = 4096
+
+    def __init__(self, sections_list, morph, gen, args, out=None,
+                 profiler=None, engine=None, baseline=None, test_file=None,
+                 history=None):
+        # the list can still be growing while a pipeline parses the file, so 
+        # indexes and selection are worked out by prepare() once it's done
         self.sections = sections_list
+        self.prepared = False
+        self.looked_up = set()
         self.morph_path = morph
         self.gen_path = gen
         self.args = args
+        self.profiler = profiler or Profiler()
+        # the engine can be shared with other test files using the same paths
+        self.engine = engine or LookupEngine(morph, gen, args, self.profiler,
+                                             limits=lookup_limits(args))
+        self.baseline = baseline
+        self.history = history
+        self.test_file = test_file
+        self.failures = 0
+        self.stopped = False
 
-        # printing stuff
-        self._io = StringIO()
+        # printing stuff, the report is written out as sections finish
+        self.out = out or sys.stdout
         self.colors = define_colors()
         self.ana_passes, self.ana_fails = 0, 0
         self.gen_passes, self.gen_fails = 0, 0
+        self.ana_limited, self.gen_limited = 0, 0
+
+    def prepare(self):
+        if self.prepared: return
+        # these indexes help ensure false positives are actually false 
+        # positives, they map each form to the set of forms expected for it
+        analysis_sets, generation_sets = {}, {}
+        for section in self.sections:
+          for test in section.tests:
+            analysis_sets.setdefault(test.right, set()).add(test.left)
+            generation_sets.setdefault(test.left, set()).add(test.right)
+        self.analysis_dict = {right: frozenset(lefts) 
+                              for right, lefts in analysis_sets.items()}
+        self.generation_dict = {left: frozenset(rights)
+                                for left, rights in generation_sets.items()}
+        self.selected = select_sections(self.sections, self.args)
+        self.prepared = True
 
-    def __str__(self):
-        return self._io.getvalue()
-    
     def color_write(self, string, *args, **kwargs):
         kwargs.update(self.colors)
-        self._io.write(string.format(*args, **kwargs))
+        self.out.write(string.format(*args, **kwargs))
 
-    def get_total_counts(self):
-        for section in self.sections:
-          self.ana_passes += section.ana_passes 
-          self.ana_fails += section.ana_fails
-          self.gen_passes += section.gen_passes
-          self.gen_fails += section.gen_fails
+    def add_counts(self, section):
+        self.ana_passes += section.ana_passes 
+        self.ana_fails += section.ana_fails
+        self.gen_passes += section.gen_passes
+        self.gen_fails += section.gen_fails
+        self.ana_limited += section.ana_limited
+        self.gen_limited += section.gen_limited
     
-    def print_normal(self): 
-        if self.args.test >= 0:
-          self.color_write(self.sections[self.args.test].create_output())
-        else:
-          for section in self.sections:
-            self.color_write(section.create_output())
-        self.print_final()
-
-    def print_compact(self):
-        if self.args.test >= 0:
-          section = self.sections[self.args.test]
-          self.color_write(section.create_output(normal_style=False))
-        else:
-          for section in self.sections:
-            self.color_write(section.create_output(normal_style=False))
-        self.print_final()
+    def print_normal(self, section): 
+        self.color_write(section.create_header())
+        for test in section.tests:
+          self.color_write(test.get_test_results())
+        self.color_write(section.create_counts())
+
+    def print_compact(self, section):
+        self.color_write(section.create_header(normal_style=False))
+        self.color_write(section.create_counts(normal_style=False))
 
     def print_final(self):
-        if self.args.test >= 0:
-          section = self.sections[self.args.test]
-          # get the section's counts
-          self.ana_passes = section.ana_passes
-          self.ana_fails = section.ana_fails
-          self.gen_passes = section.gen_passes
-          self.gen_fails = section.gen_fails 
-
-        # make passes and fails counts into strings 
-        s = 'Overall results:\n'
-        if self.ana_fails: s += ' {} '.format(fail_mark)
-        else: s += ' {} '.format(pass_mark)
+        self.color_write(create_final(self))
 
-        s += 'Analysis - {}: {}, '.format(pass_mark, self.ana_passes)
-        s += '{}: {}\n'.format(fail_mark, self.ana_fails)
+    def print_jsonl(self, section):
+        # one line per test, without any colours or wrapping
+        for test in section.tests:
+          record = OrderedDict([('type', 'test'), ('file', self.test_file),
+                                ('section', section.title), 
+                                ('number', section.number),
+                                ('left', test.left), 
+                                ('direction', test.direction),
+                                ('right', test.right),
+                                ('analysis', test.get_record('ana')),
+                                ('generation', test.get_record('gen'))])
+          self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
 
-        if self.gen_fails: s += ' {} '.format(fail_mark)
-        else: s += ' {} '.format(pass_mark)
+    def print_jsonl_totals(self):
+        record = OrderedDict([('type', 'totals'), ('file', self.test_file),
+                              ('analysis', {'passes': self.ana_passes, 
+                                            'fails': self.ana_fails,
+                                            'limited': self.ana_limited}),
+                              ('generation', {'passes': self.gen_passes,
+                                              'fails': self.gen_fails,
+                                              'limited': self.gen_limited})])
+        # --merge uses these to check that no shard is missing or stopped
+        if self.args.shard: record['shard'] = list(self.args.shard)
+        if self.stopped: 
+          record['stopped'] = True
+          record['failures'] = self.failures
+        self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
 
-        s += 'Generation - {}: {}, '.format(pass_mark, self.gen_passes)
-        s += '{}: {}'.format(fail_mark, self.gen_fails)
+    def print_junit(self, section):
+        # a testsuite per section, its <testsuites> is written by run_tests()
+        # limited tests are skipped, unless the other direction failed, and
+        # titles and forms yaml read as numbers or booleans are made strings
+        from xml.sax.saxutils import escape, quoteattr
+        title = str(section.title)
+        failed, skipped = [], []
+        for test in section.tests:
+          limited = test.limited_analysis() or test.limited_generation()
+          failed.append(test.failed())
+          skipped.append(limited and not failed[-1])
+        s = '  <testsuite name={} tests="{}" failures="{}" skipped="{}"'.format(
+            quoteattr(title), len(section.tests), sum(failed), 
+            sum(skipped))
+        if self.test_file: s += ' file={}'.format(quoteattr(self.test_file))
+        self.out.write(s + '>\n')
+        for test, fail, skip in zip(section.tests, failed, skipped):
+          name = '{} {} {}'.format(test.left, test.direction, test.right)
+          s = '    <testcase classname={} name={}'.format(
+              quoteattr(title), quoteattr(name))
+          if fail:
+            comments = test.get_comments().strip()
+            s += '>\n      <failure message={}>{}</failure>\n'.format(
+                 quoteattr(comments), escape(comments))
+            s += '    </testcase>\n'
+          elif skip:
+            comments = test.get_comments().strip()
+            s += '>\n      <skipped message={}/>\n'.format(quoteattr(comments))
+            s += '    </testcase>\n'
+          else: s += '/>\n'
+          self.out.write(s)
+        self.out.write('  </testsuite>\n')
+
+    def print_changes(self):
+        s = '\n\nChanges since the baseline:\n'
+        new_fails, new_passes = 0, 0
+        for test, direction, passed in self.baseline.changes:
+          if passed: 
+            s += ' {} '.format(pass_mark)
+            new_passes += 1
+          else: 
+            s += ' {} '.format(fail_mark)
+            new_fails += 1
+          s += '{} {} {}: '.format(test.left, test.direction, test.right)
+          s += '{} now {}.\n'.format(direction, 'passes' if passed else 'fails')
+        s += 'New failures: {}, new passes: {}'.format(new_fails, new_passes)
         self.color_write(s)
 
-    def lookup(self):
+    def lookup(self, section, tests=None):
+        # strings already looked up for an earlier section are not redone
+        if tests is None: tests = section.tests
+        self.looked_up.add(section)
+        engine = self.engine
+        before = engine.requested, engine.performed, engine.cached
+        engine.latencies = []
+
+        if self.baseline and self.args.since_baseline:
+          # tests that are unchanged since the baseline keep their results
+          changed = []
+          for test in tests:
+            ana = self.baseline.results(test, 'ana')
+            gen = self.baseline.results(test, 'gen')
+            if ana is None or gen is None: changed.append(test)
+            else: 
+              test.ana_result, test.gen_result = ana, gen
+              self.baseline.reused += 1
+          tests = changed
+
         # getting analysis data used in test
-        analysis_stream = libhfst.HfstInputStream(self.morph_path).read()
-        for section in self.sections:
-          for test in section.tests:
-            for result in analysis_stream.lookup(test.right):
-              test.ana_result.append(result[0])
-        
+        analyses = self.engine.lookup('ana', [test.right for test in tests])
+        for test in tests:
+          test.ana_result = analyses[test.right]
+
         # getting generation data used in test
-        generation_stream = libhfst.HfstInputStream(self.gen_path).read()
-        for section in self.sections:  
-          for test in section.tests:
-            for result in generation_stream.lookup(test.left):
-              test.gen_result.append(result[0])
-          
-    def run_analysis_tests(self, section):
-        if self.args.verbose: print('Running analysis tests...')
-        for test in section.tests:
-          if self.args.ignore_ana: test.ignore_ana_fp = True
-          for result in test.ana_result:
-            if test.direction == '<=' or test.direction == '<=>':
-              if result == test.left: 
-                # true positive was found
-                test.ana_missing = False
-              elif result not in self.analysis_dict[test.right]:
-                # if not in dict it's false positive 
-                test.ana_fp.append(result)
-              if test.direction == '<=>':
-                # there can't be a true negative
-                test.ana_tn = None
-            else: # test is generation only =>
-              # analysis missing is a good thing here so N/A
-              test.ana_missing = None
-              if result == test.left:
-                # this shouldn't happen, so true negative fails
-                test.ana_tn = False
-
-    def run_generation_tests(self, section):
-        if self.args.verbose: print('Running generation tests...')
-        for test in section.tests:  
-          if self.args.ignore_gen: test.ignore_gen_fp = True
-          for result in test.gen_result:
-            if test.direction == '=>' or test.direction == '<=>':
-              if result == test.right:
-                # true positive was found
-                test.gen_missing = False
-              elif result not in self.generation_dict[test.left]:
-                #if not in dict it's false positive
-                test.gen_fp.append(result)
-              if test.direction == '<=>':
-                # there can't be a true negative
-                test.gen_tn = None
-            else: # test is analysis only <=
-              # analysis missing is a good thing here so N/A
-              test.gen_missing = None
-              if result == test.right:
-                # this shouldn't happen, so true negative fails
-                test.gen_tn = False
+        generations = self.engine.lookup('gen', [test.left for test in tests])
+        for test in tests:
+          test.gen_result = generations[test.left]
+
+        self.profiler.add_section(section, engine.requested - before[0],
+                                  engine.performed - before[1],
+                                  engine.cached - before[2], engine.latencies)
+
+    def prefetch(self, sections):
+        # looks up the strings of all the sections at once, lookup() then 
+        # finds them already done
+        tests = [test for section in sections for test in section.tests]
+        if self.baseline and self.args.since_baseline:
+          tests = [test for test in tests 
+                   if self.baseline.results(test, 'ana') is None 
+                   or self.baseline.results(test, 'gen') is None]
+        self.engine.prefetch('ana', [test.right for test in tests])
+        self.engine.prefetch('gen', [test.left for test in tests])
+
+    def evaluate(self, section, tests=None, max_failures=None):
+        """
+        Works out TP, TN, FP and FN of both directions of the section's tests 
+        (or of the given ones) in one pass, along with the verdict of each test,
+        and adds them to the section's counts, which the report then reuses.
+        Stops after max_failures failed tests. Returns the number of failed 
+        tests and the number of tests evaluated.
+        """
+        if tests is None: tests = section.tests
+        ignore_ana, ignore_gen = self.args.ignore_ana, self.args.ignore_gen
+        hide_pass = self.args.hide_pass
+        analysis_dict, generation_dict = self.analysis_dict, self.generation_dict
+        counts = [0, 0, 0, 0, 0, 0]
+        failures, evaluated = 0, 0
+        for test in tests:
+          left, direction, right = test.left, test.direction, test.right
+          test.hide_passes = hide_pass
+
+          # analysis, the right side should give the left side back
+          results = test.ana_result
+          if direction == '=>': 
+            # generation only, so the analysis being missing is a good thing
+            test.ana_missing = None if results else True
+            test.ana_tn = left not in results
+            test.ana_fp = ()
+          else:
+            # for <=> there can't be a true negative
+            test.ana_missing = left not in results
+            test.ana_tn = None if direction == '<=>' and results else True
+            # results expected by any test with this right side are fine
+            expected = analysis_dict[right]
+            test.ana_fp = () if expected.issuperset(results) else \
+                          tuple(r for r in results if r not in expected)
+          test.ignore_ana_fp = ignore_ana
+
+          # generation, the left side should give the right side back
+          results = test.gen_result
+          if direction == '<=':
+            test.gen_missing = None if results else True
+            test.gen_tn = right not in results
+            test.gen_fp = ()
+          else:
+            test.gen_missing = right not in results
+            test.gen_tn = None if direction == '<=>' and results else True
+            expected = generation_dict[left]
+            test.gen_fp = () if expected.issuperset(results) else \
+                          tuple(r for r in results if r not in expected)
+          test.ignore_gen_fp = ignore_gen
+
+          # verdicts, tests whose lookups hit a limit neither pass nor fail
+          verdict = 0
+          if test.limited_analysis(): counts[2] += 1
+          elif not test.ana_missing and test.ana_tn is not False and \
+          (ignore_ana or not test.ana_fp):
+            verdict |= ana_passed_bit
+            counts[0] += 1
+          else: 
+            verdict |= failed_bit
+            counts[1] += 1
+          if test.limited_generation(): counts[5] += 1
+          elif not test.gen_missing and test.gen_tn is not False and \
+          (ignore_gen or not test.gen_fp):
+            verdict |= gen_passed_bit
+            counts[3] += 1
+          else: 
+            verdict |= failed_bit
+            counts[4] += 1
+          test.verdict = verdict
+          evaluated += 1
+          if verdict & failed_bit: 
+            failures += 1
+            if failures == max_failures: break
+
+        section.ana_passes += counts[0]
+        section.ana_fails += counts[1]
+        section.ana_limited += counts[2]
+        section.gen_passes += counts[3]
+        section.gen_fails += counts[4]
+        section.gen_limited += counts[5]
+        return failures, evaluated
 
     def run(self):
-        self.lookup()
-        if self.args.test >= 0:
-          if self.args.test > len(self.sections) - 1: error_checking(7)
-          if self.args.verbose:
-            print('Running tests on section #{}'.format(self.args.test))
-          section = self.sections[self.args.test]
-          
-          # runnning tests
-          self.run_analysis_tests(section)
-          self.run_generation_tests(section)
-        else:
-          for section in self.sections:
-            if self.args.verbose: 
-              print('Running tests on section #{}'.format(section.number))
-                
-            # running tests
-            self.run_analysis_tests(section)
-            self.run_generation_tests(section)
-        
-        # if passes are to be hidden
-        if self.args.hide_pass:
-          for section in self.sections:
-            for test in section.tests:
-              test.hide_passes = True
-        
-        # getting all counts 
-        for section in self.sections:
-          section.get_counts()
-        self.get_total_counts()
+        if self.args.output not in text_outputs + machine_outputs + ['none']:
+          error_checking(8)
+        self.prepare()
+        if self.args.backend == 'compose':
+          # composition pays off when all the strings are composed together
+          with self.profiler.phase('lookup'):
+            self.prefetch([section for section in self.selected 
+                           if section not in self.looked_up])
+
+        # sections with recent failures go first, a broken build shows soon,
+        # and so do the tests that failed recently within each section
+        sections = self.selected
+        max_failures = self.args.max_failures
+        ordered = self.history and (self.args.failed_first or max_failures)
+        if ordered:
+          sections = sorted(sections, key=self.history.priority, reverse=True)
+
+        # each section is looked up, tested and written out before the next,
+        # unless a pipeline already looked it up while parsing
+        for section in sections:
+          if ordered:
+            section.tests = sorted(section.tests, reverse=True,
+                                   key=self.history.last_failure)
+          if self.args.verbose: 
+            print('Running tests on section #{}'.format(section.number))
+
+          # with --max-failures, tests are looked up and tested in batches
+          # that grow from a few tests, so the run stops soon after the
+          # failure that ends it instead of at the end of the section
+          looked_up = section in self.looked_up
+          size = self.first_batch if max_failures else len(section.tests)
+          done = 0
+          while done < len(section.tests):
+            batch = section.tests[done:done+size]
+            if not looked_up:
+              with self.profiler.phase('lookup'): self.lookup(section, batch)
+              
+            with self.profiler.phase('evaluation'):
+              # running tests and getting counts
+              failures, evaluated = self.evaluate(section, batch, 
+                max_failures - self.failures if max_failures else None)
+              batch = batch[:evaluated]
+              if self.baseline:
+                for test in batch:
+                  self.baseline.record(test)
+              if self.history:
+                for test in batch:
+                  self.history.record(test)
+              self.failures += failures
+            done += evaluated
+            size = min(size * 2, self.last_batch)
+            if max_failures and self.failures >= max_failures:
+              self.stopped = True
+              break
+          self.add_counts(section)
+
+          # type of output, only the tests that ran are written out
+          if done < len(section.tests): section = section.first(done)
+          with self.profiler.phase('report'):
+            if self.args.output == 'normal': self.print_normal(section)
+            elif self.args.output == 'compact': self.print_compact(section)
+            elif self.args.output == 'jsonl': self.print_jsonl(section)
+            elif self.args.output == 'junit': self.print_junit(section)
+            self.out.flush()
+          if self.stopped: break
 
-        # type of output
-        if self.args.output == 'normal': self.print_normal()
-        elif self.args.output == 'compact': self.print_compact()
-        elif self.args.output == 'final': self.print_final()
-        elif self.args.output != 'none': error_checking(8)
-        print(self)
+        if self.args.verbose: print(self.engine.report())
+        if self.args.verbose and self.baseline and self.args.since_baseline:
+          print('Reused baseline results of {} tests.'.format(
+                self.baseline.reused))
+        with self.profiler.phase('report'):
+          if self.args.output in text_outputs: 
+            self.print_final()
+            if self.args.since_baseline: self.print_changes()
+            if self.stopped: 
+              self.color_write('\n\nStopped after {} failures.', self.failures)
+          if self.args.output == 'jsonl': self.print_jsonl_totals()
+          if self.args.output not in machine_outputs: self.color_write('\n')
+          self.out.flush()
 
         # exit code
-        if self.args.test >= 0:
-          section = self.sections[self.args.test]
-          if section.ana_fails or section.gen_fails: return 1
-          else: return 0
-        else: # all
-          if self.ana_fails or self.gen_fails: return 1
-          else: return 0
-
-def load_data(args):
-    try: yaml_file = open(args.test_file, 'r')
+        if self.history: self.history.save()
+        if self.ana_fails or self.gen_fails: return 1
+        else: return 0
+
+# bumped whenever the layout of cached test files changes
+suite_version = 2
+
+def load_suite(path):
+    """
+    Returns the sections, morph, gen and lookup limits of a test file saved 
+    by save_suite(), or None if there is no usable cached copy.
+    """
+    try:
+      with open(path, 'rb') as f: suite = marshal.load(f)
+    except: return None
+    if suite[0] != suite_version: return None
+    version, morph, gen, limits, sections = suite
+
+    all_sections = []
+    for num, (title, tests) in enumerate(sections):
+      tests = [MorphTest(left, right, direction) 
+               for left, right, direction in tests]
+      all_sections.append(Section(title, num, None, tests))
+    return all_sections, morph, gen, limits
+
+def save_suite(path, morph, gen, limits, all_sections):
+    sections = [(section.title, [(test.left, test.right, test.direction)
+                                 for test in section.tests])
+                for section in all_sections]
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      temporary = '{}.{}.tmp'.format(path, os.getpid())
+      with open(temporary, 'wb') as f:
+        marshal.dump((suite_version, morph, gen, limits, sections), f)
+      os.replace(temporary, path)
+      # copies of earlier versions of the same test file are not needed again
+      prefix = path.rsplit('.', 2)[0]
+      for old in glob.glob(glob.escape(prefix) + '.*.suite'):
+        if old != path: os.remove(old)
+    except (OSError, ValueError): pass # the cache is only an optimization
+
+def read_test_file(args, test_file):
+    """
+    Reads a test file. Returns its contents, the path it is cached under and,
+    if it was parsed before and hasn't changed, what load_data() returns.
+    """
+    try: 
+      with open(test_file, 'rb') as yaml_file: data = yaml_file.read()
     except: error_checking(2)
     if args.verbose: print('Opened file.')
+
+    # test files that have not changed are loaded from the cache
+    cached, suite = None, None
+    if not args.no_cache:
+      name = cache_name(test_file, 
+                        '{}.suite'.format(hashlib.sha1(data).hexdigest()))
+      cached = os.path.join(cache_directory(args), name)
+      suite = load_suite(cached)
+      if suite and args.verbose: 
+        print('Loaded section objects from the cache.')
+    return data, cached, suite
+
+def parse_test_file(data):
+    """
+    Parses a test file a section at a time, checking its format. Yields 
+    ('config', morph, gen, limits) and ('section', number, title, triples) 
+    for each section as soon as they are parsed, limits being MaxResults and
+    TimeLimit and triples what test_triples() returns. Only plain tuples are
+    yielded, so they can be sent to another process as they are. A repeated
+    section title is yielded again with the number it had the first time.
+    """
+    config, sections = False, {}
+    for key, title, value in yaml_load_sections(data):
+      if key == 'Config':
+        if not value: error_checking(3)
+        try:
+          # getting config - script currently only works with .hfst files
+          hfst_config = value['hfst']
+          morph = hfst_config['Morph']
+          gen = hfst_config['Gen']
+        except: error_checking(4)
+        # optional limits for each lookup
+        max_results = hfst_config.get('MaxResults')
+        time_limit = hfst_config.get('TimeLimit')
+        if max_results is not None and \
+        (type(max_results) is not int or max_results <= 0): error_checking(14)
+        if time_limit is not None and \
+        (type(time_limit) not in (int, float) or time_limit <= 0): 
+          error_checking(14)
+        config = True
+        yield 'config', morph, gen, (max_results, time_limit)
+
+      elif key == 'Tests':
+        # error if the section isn't an ordered dictionary
+        if title is None and not value: error_checking(3)
+        if not isinstance(value, OrderedDict): error_checking(5)
+        number = sections.setdefault(title, len(sections))
+        yield 'section', number, title, test_triples(value)
+
+      # the file should contain only config and tests
+      else: error_checking(3)
+    if not config or not sections: error_checking(3)
+
+def load_data(args, test_file):
+    data, cached, suite = read_test_file(args, test_file)
+    if suite: return suite
   
-    # creating an ordered dictionary from the yaml file
-    dictionary = yaml_load_ordered(yaml_file)
-    yaml_file.close()
-    if args.verbose: print('Created dictionary from yaml file.')
-      
-    # ensure dictionary contains only config and tests
-    if not dictionary['Config'] or not dictionary['Tests']: error_checking(3)
-    if len(dictionary) != 2: error_checking(3)
+    all_sections = []
+    for item in parse_test_file(data):
+      if item[0] == 'config': morph, gen, limits = item[1:]
+      else: add_section(all_sections, *item[1:])
+    if args.verbose: print('Created section objects.')
+
+    if cached: save_suite(cached, morph, gen, limits, all_sections)
+    return all_sections, morph, gen, limits
 
+def parse_in_background(data, connection):
+    """
+    Sends what parse_test_file() yields through connection, followed by 
+    ('done', wall, cpu) or ('exit', code) when the parsing fails.
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
     try:
-      # getting config - script currently only works with .hfst files
-      hfst_config = dictionary['Config']['hfst']
-      morph = hfst_config['Morph']
-      gen = hfst_config['Gen']
+      for item in parse_test_file(data):
+        connection.send(item)
+      connection.send(('done', time.perf_counter() - wall, 
+                       time.process_time() - cpu))
+    except SystemExit as e: connection.send(('exit', e.code))
+    except BaseException:
+      traceback.print_exc()
+      connection.send(('exit', 1))
+    finally: 
+      sys.stdout.flush()
+      sys.stderr.flush()
+      connection.close()
 
-      # getting tests
-      tests = dictionary['Tests']
-    except: error_checking(4)
+def load_config(args, test_file):
+    """
+    Returns the morph, gen and lookup limits of a test file, without parsing
+    more of it than needed.
+    """
+    data, cached, suite = read_test_file(args, test_file)
+    if suite: return suite[1:]
+    for item in parse_test_file(data):
+      if item[0] == 'config': return item[1:]
 
-    all_sections = []
-    for num, title in enumerate(tests):
-      # error if tests[title] isn't an ordered dictionary
-      if not isinstance(tests[title], OrderedDict): error_checking(5)
-      section = Section(title, num, tests[title])
-      all_sections.append(section)
+def parse_in_process(data, profiler):
+    # what parse_in_background() sends, for runs without a process to spare
+    items = parse_test_file(data)
+    while True:
+      with profiler.phase('load_data'): item = next(items, None)
+      if item is None: return
+      yield item
+
+def received(receiver):
+    # the items sent by parse_in_background(), until the parsing ends
+    while True:
+      try: item = receiver.recv()
+      except EOFError: item = ('exit', 1)
+      if item[0] == 'exit': sys.exit(item[1])
+      yield item
+      if item[0] == 'done': return
+
+def pipeline(args, data, start, profiler):
+    """
+    Parses a test file in another process, overlapping the parsing with the
+    rest of the run: as soon as the config is parsed, start(morph, gen, 
+    limits, sections) is called to get the Results, which starts loading the 
+    transducers, and each section is looked up as soon as it is parsed. 
+    Returns the Results, the sections and the limits in "Config" once the 
+    whole file is parsed.
+    """
+    # parsing is done by a process of its own, a thread would have to share
+    # the interpreter with the lookups, but with a single cpu the process 
+    # would only take turns with this one
+    parser = None
+    if os.cpu_count() == 1: items = parse_in_process(data, profiler)
+    else:
+      context = process_context()
+      receiver, sender = context.Pipe(duplex=False)
+      parser = context.Process(target=parse_in_background, 
+                               args=(data, sender), daemon=True)
+      parser.start()
+      sender.close()
+      items = received(receiver)
+
+    results, all_sections, waiting, limits = None, [], [], None
+    try:
+      for item in items:
+        if item[0] == 'done': 
+          profiler.add_phase('load_data', item[1], item[2])
+        elif item[0] == 'config': 
+          morph, gen, limits = item[1:]
+          results = start(morph, gen, limits, all_sections)
+        else:
+          # a repeated title replaces the tests of the earlier section
+          repeated = item[1] < len(all_sections)
+          section = add_section(all_sections, *item[1:])
+          if repeated and results: results.looked_up.discard(section)
+          waiting.append(section)
+
+        # sections parsed before the config have to wait for it, with
+        # --backend compose they are all looked up together by run(), and
+        # with --max-failures run() looks up only as many as it needs
+        if results and (args.backend == 'compose' or args.max_failures): 
+          waiting = []
+        elif results:
+          for section in waiting:
+            with profiler.phase('lookup'):
+              results.lookup(section, wanted_tests(section, args))
+          waiting = []
+    finally:
+      if parser:
+        receiver.close()
+        parser.join()
     if args.verbose: print('Created section objects.')
+    return results, all_sections, limits
+
+def run_tests(args, resident=None):
+    """
+    Runs the tests of every test file and returns 1 if any of them failed.
+    """
+    profiler = Profiler(bool(args.profile))
+    if args.cprofile:
+      import cProfile
+      cprofiler = cProfile.Profile()
+      cprofiler.enable()
+
+    out = sys.stdout
+    if args.output_file:
+      try: out = open(args.output_file, 'w')
+      except: error_checking(11)
+
+    test_files = expand_test_files(args.test_files)
+    engines = {}
+    code = 0
+    try:
+      if args.output == 'junit':
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n')
+      for test_file in test_files:
+        def start(morph, gen, limits, sections):
+          # files with the same transducers and limits share one engine, so 
+          # transducers are loaded and strings looked up once for all files
+          limits = lookup_limits(args, limits)
+          key = (os.path.abspath(morph), os.path.abspath(gen), limits)
+          if key not in engines:
+            engines[key] = LookupEngine(morph, gen, args, profiler, resident,
+                                        limits)
+            engines[key].preload()
+
+          baseline = None
+          if args.write_baseline or args.since_baseline:
+            name = cache_name(test_file, 'baseline')
+            hashes = {'ana': file_hash(morph), 'gen': file_hash(gen)}
+            baseline = Baseline(os.path.join(cache_directory(args), name),
+                                hashes)
+          history = None
+          if not args.no_cache:
+            name = cache_name(test_file, 'history')
+            history = FailureHistory(os.path.join(cache_directory(args), name))
+          return Results(sections, morph, gen, args, out, profiler, 
+                         engines[key], baseline, test_file, history)
+
+        with profiler.phase('load_data'):
+          data, cached, suite = read_test_file(args, test_file)
+        if suite: 
+          sections, morph, gen, limits = suite
+          results = start(morph, gen, limits, sections)
+        else:
+          # parsing, transducer loading and lookups overlap in a pipeline
+          results, sections, limits = pipeline(args, data, start, profiler)
+          if cached: 
+            save_suite(cached, results.morph_path, results.gen_path, limits,
+                       sections)
+
+        if args.verbose: print('Getting results...')
+        if len(test_files) > 1 and args.output in text_outputs:
+          if test_file != test_files[0]: out.write('\n')
+          out.write('Test file: {}\n\n'.format(test_file))
+        code = max(code, results.run())
+        if results.baseline: 
+          partial = bool(args.test or args.filter or args.shard or 
+                         results.stopped)
+          results.baseline.save(partial=partial)
+        # --max-failures stops the files that are left too
+        if results.stopped: break
+      if args.output == 'junit': out.write('</testsuites>\n')
+      return code
+    finally: 
+      for engine in engines.values():
+        engine.close()
+      if out is not sys.stdout: out.close()
+      if args.cprofile:
+        cprofiler.disable()
+        cprofiler.dump_stats(args.cprofile)
+      if args.profile: profiler.write(args.profile)
+
+# what counts as a word in a corpus, with inner hyphens and apostrophes
+word_pattern = re.compile(r"\w+(?:[-'’]\w+)*")
+
+def corpus_coverage(args, resident=None):
+    """
+    Analyzes the words of the corpus in args.coverage with the analyzer of the
+    first test file and reports how many of them are known, as well as the 
+    most frequent unknown words. The corpus is read a line at a time, only the
+    count of each different word is kept.
+    """
+    if args.output not in text_outputs + machine_outputs + ['none']:
+      error_checking(8)
+    profiler = Profiler(bool(args.profile))
+    test_file = expand_test_files(args.test_files)[0]
+    with profiler.phase('load_data'):
+      morph, gen, limits = load_config(args, test_file)
+    # the words of a corpus would push the tests' lookups out of the cache
+    engine = LookupEngine(morph, gen, args, profiler, resident, 
+                          lookup_limits(args, limits), cache=False)
+
+    counts = Counter()
+    try:
+      with profiler.phase('tokenize'):
+        if args.coverage == '-': corpus = sys.stdin
+        else: corpus = open(args.coverage, encoding='utf-8', errors='replace')
+        with corpus: 
+          for line in corpus: counts.update(word_pattern.findall(line))
+    except OSError: error_checking(17)
+    if args.verbose: print('Found {} different words.'.format(len(counts)))
+
+    # words are analyzed in batches, so only one batch of results is kept
+    unknown = Counter()
+    words = list(counts)
+    try:
+      with profiler.phase('lookup'):
+        for i in range(0, len(words), 10000):
+          batch = words[i:i+10000]
+          analyses = engine.lookup('ana', batch)
+          for word in batch:
+            if not analyses[word]: unknown[word] = counts[word]
+          engine.forget('ana')
+    finally: engine.close()
+
+    tokens, types = sum(counts.values()), len(counts)
+    known_tokens = tokens - sum(unknown.values())
+    known_types = types - len(unknown)
+    def percent(part, whole): return 100.0 * part / whole if whole else 0.0
+
+    out = sys.stdout
+    if args.output_file:
+      try: out = open(args.output_file, 'w')
+      except: error_checking(11)
+    with profiler.phase('report'):
+      if args.output == 'jsonl':
+        record = OrderedDict([('type', 'coverage'), ('corpus', args.coverage),
+                              ('analyzer', morph), ('tokens', tokens),
+                              ('known_tokens', known_tokens), 
+                              ('types', types), ('known_types', known_types),
+                              ('unknown', unknown.most_common(args.top))])
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+      elif args.output != 'none':
+        s = 'Coverage of {} with {}:\n'.format(args.coverage, morph)
+        s += ' Words: {}, known: {} ({:.2f}%)\n'.format(tokens, known_tokens,
+             percent(known_tokens, tokens))
+        s += ' Different words: {}, known: {} ({:.2f}%)\n'.format(types, 
+             known_types, percent(known_types, types))
+        if unknown and args.top > 0:
+          s += '\nMost frequent unknown words:\n'
+          for word, count in unknown.most_common(args.top):
+            s += ' {:>9} {}\n'.format(count, word)
+        out.write(s)
+    if out is not sys.stdout: out.close()
+    if args.profile: profiler.write(args.profile)
+    return 0
+
+def round_trip(args, resident=None):
+    """
+    Analyzes each word of the list in args.word_list, or the right side
+    of every test, and generates from every analysis. Reports the words that 
+    an analysis doesn't generate again, and those for which an analysis 
+    also generates other forms. Returns 1 if there are any.
+    """
+    profiler = Profiler(bool(args.profile))
+    test_file = expand_test_files(args.test_files)[0]
+    with profiler.phase('load_data'):
+      if args.word_list:
+        morph, gen, limits = load_config(args, test_file)
+        try:
+          if args.word_list == '-': word_list = sys.stdin
+          else: word_list = open(args.word_list, encoding='utf-8')
+          with word_list: 
+            words = list(OrderedDict.fromkeys(line.strip() for line in word_list
+                                              if line.strip()))
+        except (OSError, UnicodeDecodeError): error_checking(18)
+      else:
+        sections, morph, gen, limits = load_data(args, test_file)
+        words = list(OrderedDict.fromkeys(str(test.right) 
+                                          for section in sections 
+                                          for test in section.tests))
+    engine = LookupEngine(morph, gen, args, profiler, resident,
+                          lookup_limits(args, limits))
+
+    # every analysis is only generated from once, however many words share it
+    try:
+      with profiler.phase('lookup'):
+        analyses = {}
+        for i in range(0, len(words), 10000):
+          analyses.update(engine.lookup('ana', words[i:i+10000]))
+        unique = list(OrderedDict.fromkeys(analysis 
+                                           for word in words
+                                           for analysis in analyses[word]))
+        for i in range(0, len(unique), 10000):
+          engine.lookup('gen', unique[i:i+10000])
+        generations = engine.results['gen']
+    finally: engine.close()
+
+    with profiler.phase('evaluation'):
+      unknown, problems = 0, []
+      for word in words:
+        if not analyses[word]: 
+          unknown += 1
+          continue
+        missing = [analysis for analysis in analyses[word] 
+                   if word not in generations[analysis]]
+        # analyses that do generate the word again, but other forms too
+        extra = OrderedDict()
+        for analysis in analyses[word]:
+          if analysis in missing: continue
+          others = [form for form in generations[analysis] if form != word]
+          if others: extra[analysis] = others
+        if missing or extra: problems.append((word, missing, extra))
+    not_regenerated = sum(1 for word, missing, extra in problems if missing)
+    overgenerated = sum(1 for word, missing, extra in problems if extra)
+
+    out = sys.stdout
+    if args.output_file:
+      try: out = open(args.output_file, 'w')
+      except: error_checking(11)
+    with profiler.phase('report'):
+      if args.output == 'jsonl':
+        for word, missing, extra in problems:
+          record = OrderedDict([('type', 'round-trip'), ('word', word),
+                                ('not_regenerated', missing),
+                                ('overgenerated', extra)])
+          out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        record = OrderedDict([('type', 'totals'), ('words', len(words)),
+                              ('unknown', unknown), 
+                              ('analyses', len(unique)),
+                              ('not_regenerated', not_regenerated),
+                              ('overgenerated', overgenerated)])
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+      elif args.output != 'none':
+        colors = define_colors()
+        s = 'Round trip of {} words through {} and {}:\n'.format(len(words), 
+             morph, gen)
+        s += ' Unknown: {}, different analyses: {}\n'.format(unknown, 
+             len(unique))
+        s += ' Not generated again: {}, overgenerated: {}\n'.format(
+             not_regenerated, overgenerated)
+        for word, missing, extra in problems[:max(args.top, 0)]:
+          s += '\n{} {}\n'.format(fail_mark, word)
+          for analysis in missing:
+            s += '   {} does not generate it'.format(analysis)
+            if generations[analysis]:
+              s += ', only {}'.format(', '.join(generations[analysis]))
+            s += '\n'
+          for analysis, others in extra.items():
+            s += '   {} also generates {}\n'.format(analysis, 
+                                                    ', '.join(others))
+        out.write(s.format(**colors))
+    if out is not sys.stdout: out.close()
+    if args.profile: profiler.write(args.profile)
+    return 1 if problems else 0
+
+def run(args, resident=None):
+    # other modes use the test files for something else than running tests
+    if args.merge: return merge_results(args)
+    if args.coverage: return corpus_coverage(args, resident)
+    if args.round_trip: return round_trip(args, resident)
+    return run_tests(args, resident)
+
+class SocketWriter:
+    """
+    File-like object that sends what is written to it to a client, as JSON
+    lines tagged with the stream they belong to.
+    """
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+
+    def write(self, string):
+        message = json.dumps({self.stream: string}) + '\n'
+        self.connection.sendall(message.encode('utf-8'))
+        return len(string)
+
+    def flush(self):
+        pass
+
+def merge_results(args):
+    """
+    Adds up the totals of the -o jsonl results in args.test_files, e.g. the
+    shards of a suite, and prints the overall results of each test file the 
+    same way a single run would. Returns 1 if any of them failed.
+    """
+    totals, shards, stopped = OrderedDict(), {}, Counter()
+    for path in expand_test_files(args.test_files):
+      try:
+        with open(path, encoding='utf-8') as f:
+          records = [json.loads(line) for line in f if line.strip()]
+      except (OSError, ValueError): error_checking(15)
+      # a run writes the totals of each test file last, once, so results
+      # without them are from a run that didn't finish
+      seen = set()
+      try:
+        for record in records:
+          if record.get('type') != 'totals': continue
+          if record['file'] in seen: error_checking(19)
+          seen.add(record['file'])
+          counts = totals.get(record['file'])
+          if counts is None:
+            counts = totals[record['file']] = Section(record['file'], 0, None, 
+                                                      [])
+          for direction, prefix in [('analysis', 'ana'), ('generation', 'gen')]:
+            for key in ['passes', 'fails', 'limited']:
+              name = '{}_{}'.format(prefix, key)
+              setattr(counts, name, getattr(counts, name) + 
+                                    record[direction].get(key, 0))
+          if 'shard' in record:
+            shards.setdefault(record['file'], []).append(
+              tuple(record['shard']))
+          # runs stopped by --max-failures only count what they ran
+          if record.get('stopped'): 
+            stopped[record['file']] += record.get('failures', 0)
+      except (AttributeError, KeyError, TypeError): error_checking(15)
+      if not seen: error_checking(19)
+
+    # each shard of a file has to be there once
+    for shard_list in shards.values():
+      count = shard_list[0][1]
+      if sorted(shard_list) != [(i, count) for i in range(1, count + 1)]:
+        error_checking(16)
+
+    out = sys.stdout
+    if args.output_file:
+      try: out = open(args.output_file, 'w')
+      except: error_checking(11)
+    try:
+      if args.output != 'none':
+        for i, (test_file, counts) in enumerate(totals.items()):
+          if len(totals) > 1:
+            if i: out.write('\n')
+            out.write('Test file: {}\n\n'.format(test_file))
+          s = create_final(counts)
+          if test_file in stopped:
+            s += '\n\nStopped after {} failures.'.format(stopped[test_file])
+          out.write(s.format(**define_colors()) + '\n')
+    finally:
+      if out is not sys.stdout: out.close()
+    return int(bool(stopped) or any(counts.ana_fails or counts.gen_fails 
+                                    for counts in totals.values()))
+
+def serve(path):
+    """
+    Runs tests for clients connecting to the Unix socket at path, one at a 
+    time, with the transducers staying loaded between runs.
+    """
+    resident = ResidentTransducers()
+    if os.path.exists(path): os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user running the server may connect, clients can write files
+    umask = os.umask(0o177)
+    try: server.bind(path)
+    finally: os.umask(umask)
+    server.listen()
+    print('Serving tests on {}.'.format(path))
+    try:
+      while True:
+        connection, address = server.accept()
+        cwd = os.getcwd()
+        # a client that sends nothing usable or goes away only loses its run
+        try:
+          with connection:
+            # a request is a single line with the client's arguments and cwd
+            request = json.loads(connection.makefile('r', encoding='utf-8')
+                                 .readline())
+            out = SocketWriter(connection, 'out')
+            code = 0
+            try:
+              with redirect_stdout(out), redirect_stderr(SocketWriter(
+                                                      connection, 'err')):
+                os.chdir(request['cwd'])
+                args = argument_parsing(request['argv'])
+                args.connect = None
+                code = run(args, resident)
+            except SystemExit as e: 
+              code = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+              out.write('Error: {}\n'.format(e))
+              code = 1
+            connection.sendall((json.dumps({'exit': code}) + '\n').encode())
+        except (OSError, ValueError): pass
+        finally: os.chdir(cwd)
+    except KeyboardInterrupt: pass
+    finally:
+      server.close()
+      os.remove(path)
+    return 0
 
-    return all_sections, morph, gen
+def connect(path):
+    # sends the arguments to the server and prints what it sends back
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try: client.connect(path)
+    except OSError: error_checking(12)
+    request = {'argv': sys.argv[1:], 'cwd': os.getcwd()}
+    client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    code = 1
+    for line in client.makefile('r', encoding='utf-8'):
+      message = json.loads(line)
+      if 'out' in message: sys.stdout.write(message['out'])
+      elif 'err' in message: sys.stderr.write(message['err'])
+      elif 'exit' in message: code = message['exit']
+    client.close()
+    return code
 
 def main(): 
     args = argument_parsing()
-    sections, morph, gen = load_data(args)
-    if args.verbose: print('Getting results...')
-    results = Results(sections, morph, gen, args)
-    return results.run()
+    if args.serve: return serve(args.serve)
+    if args.connect: return connect(args.connect)
+    return run(args)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())